@@ -0,0 +1,221 @@
+""" Benchmarks of the env.py hot paths, results are printed and saved as JSON.
+
+Every benchmark reports its throughput along with the peak resident memory of the process so far,
+results of different commits can be compared by diffing the saved files.
+"""
+import argparse
+import json
+import resource
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+import env
+from env import Ant, Environment, GrassHoper, Grid
+from observation import Observer
+import rollout
+
+FOOD_PER_SEASON = [6, 7, 5, 2]
+
+class LegacyCell(object):
+    """The cell layout env.py used before the grid went array-backed, kept to compare against."""
+    def __init__(self, energy):
+        self._newly = 0
+        self._stored = 0
+        self._energy = energy
+
+def _allocated(build):
+    """Returns the number of bytes still allocated by build once it returned."""
+    tracemalloc.start()
+    built = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+    return size
+
+def _legacy(height, width):
+    cells = [[LegacyCell(5) for j in range(width)] for i in range(height)]
+    seeded = [[False for j in range(width)] for i in range(height)]
+    return cells, seeded
+
+def _peak_rss():
+    """Peak resident memory of the process in bytes, ru_maxrss is in kilobytes on linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def memory(height, width):
+    """Bytes per cell of the legacy list of Cell objects against the array-backed Grid."""
+    cells = height * width
+    return {
+        'height': height,
+        'width': width,
+        'legacy_bytes_per_cell': _allocated(lambda: _legacy(height, width)) / cells,
+        'grid_bytes_per_cell': _allocated(lambda: Grid(height, width)) / cells,
+    }
+
+def init(size, repeat):
+    """Environment construction, grid allocation and _generate_init_env included."""
+    start = time.perf_counter()
+    for seed in range(repeat):
+        Environment(size, size, 10, FOOD_PER_SEASON, seed=seed)
+    elapsed = time.perf_counter() - start
+    return {'size': size, 'inits_per_sec': repeat / elapsed, 'peak_rss': _peak_rss()}
+
+def simulate(size, density, ticks, incremental):
+    """Environment.simulate when a density fraction of the cells runs out of food every tick.
+
+    Draining the cells is not timed, only the ticks are.
+    """
+    environment = Environment(size, size, 10, FOOD_PER_SEASON, incremental, seed=0)
+    environment.simulate()
+    rng = np.random.default_rng(0)
+    grid = environment.grid
+    drained = max(1, int(density * size * size))
+
+    elapsed = 0.0
+    for _ in range(ticks):
+        for cell in rng.integers(0, size * size, size=drained).tolist():
+            i, j = divmod(cell, size)
+            newly = grid.newly_at(i, j)
+            if newly > 0:
+                grid.decrease_newly(i, j, newly)
+        start = time.perf_counter()
+        environment.simulate()
+        elapsed = elapsed + time.perf_counter() - start
+    return {
+        'size': size,
+        'density': density,
+        'incremental': incremental,
+        'ticks_per_sec': ticks / elapsed,
+        'peak_rss': _peak_rss(),
+    }
+
+def actions(size, count, incremental):
+    """Throughput of Ant.forage, Agent.move and Agent.eat, each call ticks the environment."""
+    environment = Environment(size, size, 10, FOOD_PER_SEASON, incremental, seed=0)
+    environment.simulate()
+    # agents that never run out of energy so that every call goes through.
+    ant = Ant(10 ** 9, 10 ** 9, environment, 1, 1, 1, 1)
+    hopper = GrassHoper(10 ** 9, 10 ** 9, environment, 1, 1, 1, 1)
+    # enough stored food under the grasshoper for every eat call to succeed.
+    environment.grid.store(hopper.i, hopper.j, count)
+
+    moves = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+    calls = {
+        'forage': ant.forage,
+        'move': lambda k: ant.move(*moves[k % 4]),
+        'eat': hopper.eat,
+    }
+    results = {'size': size, 'incremental': incremental}
+    for name, call in calls.items():
+        start = time.perf_counter()
+        if name == 'move':
+            for k in range(count):
+                call(k)
+        else:
+            for _ in range(count):
+                call()
+        results[name + '_per_sec'] = count / (time.perf_counter() - start)
+    results['peak_rss'] = _peak_rss()
+    return results
+
+def episodes(size, population, steps, count):
+    """Full multi-agent episodes of the rollout runner played in this process."""
+    args = env.parse(['--height', str(size), '--width', str(size), '--population',
+                      str(population), '--steps', str(steps), '--incremental'])
+    rounds = 0
+    start = time.perf_counter()
+    for seed in range(count):
+        rounds = rounds + rollout.episode(args, seed)['length']
+    elapsed = time.perf_counter() - start
+    return {
+        'size': size,
+        'population': population,
+        'episodes_per_sec': count / elapsed,
+        'rounds_per_sec': rounds / elapsed,
+        'peak_rss': _peak_rss(),
+    }
+
+def observe(size, population, window, count):
+    """Agents observed per second through show one by one and through an Observer window."""
+    environment = Environment(size, size, 10, FOOD_PER_SEASON, seed=0)
+    agents = [Ant(100, 90, environment, 1, 1, 1, 1) if k % 2 == 0
+              else GrassHoper(100, 90, environment, 1, 1, 1, 1) for k in range(population)]
+    observer = Observer(size, size, window, capacity=population)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        for agent in agents:
+            agent.show()
+    show = count * population / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        observer.agents(environment, agents)
+    windows = count * population / (time.perf_counter() - start)
+    return {
+        'size': size,
+        'population': population,
+        'window': window,
+        'show_per_sec': show,
+        'windows_per_sec': windows,
+        'peak_rss': _peak_rss(),
+    }
+
+def _commit():
+    """Returns the commit the benchmark runs on, None outside of a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    """Run every benchmark for the sizes and densities given on the command line."""
+    results = {'commit': _commit(), 'init': [], 'simulate': [], 'actions': [], 'episodes': [],
+               'observe': []}
+    for size in args.sizes:
+        results['init'].append(init(size, args.repeat))
+        for density in args.densities:
+            for incremental in (False, True):
+                results['simulate'].append(simulate(size, density, args.ticks, incremental))
+        for incremental in (False, True):
+            results['actions'].append(actions(size, args.actions, incremental))
+        results['episodes'].append(episodes(size, args.population, args.steps, args.episodes))
+        results['observe'].append(observe(size, args.population, args.window, args.ticks))
+    results['memory'] = memory(args.sizes[-1], args.sizes[-1])
+    return results
+
+def parse():
+    """Parse command line args to get the sizes and workloads to benchmark."""
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[10, 100, 500],
+                        help='side lengths of the square environments to benchmark')
+    parser.add_argument('-d', '--densities', type=float, nargs='+', default=[0.001, 0.01],
+                        help='fraction of the cells running out of food every tick')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of environments to build for the init benchmark')
+    parser.add_argument('-t', '--ticks', type=int, default=100,
+                        help='number of ticks of the simulate benchmark')
+    parser.add_argument('-a', '--actions', type=int, default=1000,
+                        help='number of calls of every action of the actions benchmark')
+    parser.add_argument('-p', '--population', type=int, default=10,
+                        help='number of agents of the episodes benchmark')
+    parser.add_argument('-steps', '--steps', type=int, default=100,
+                        help='maximum number of rounds of an episode')
+    parser.add_argument('-n', '--episodes', type=int, default=3,
+                        help='number of episodes of the episodes benchmark')
+    parser.add_argument('-w', '--window', type=int, default=5,
+                        help='side length of the windows of the observe benchmark')
+    parser.add_argument('-o', '--output', default=None,
+                        help='file to save the results to as JSON')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
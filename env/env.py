@@ -1,8 +1,15 @@
 """ Environment representation with food scattered across in a random manner.
 """
 import argparse
+import contextlib
+import copy
 from enum import Enum
-import random
+import mmap
+import struct
+
+import numpy as np
+
+import instrument
 
 class Season(Enum):
     """Season is a representation of the human year's seasonal episodes."""
@@ -17,116 +24,553 @@ class Season(Enum):
         season = (season + 1) % len(Season.__members__.items())
         return Season(season)
 
-class Cell(object):
-    """Environment's representation of cell with the newly and stored food."""
-    def __init__(self):
-        self._newly = 0
-        self._stored = 0
+# Snapshots start with a fixed header: magic, height, width, cycle, t, season, the four production
+# thresholds, capacity, nfree, number of agents and incremental flag, padded to 64 bytes. The grid
+# arrays follow in order newly, stored, energy, free, slot, seeded, then one record per agent.
+_SNAPSHOT_MAGIC = b'ENVSNAP1'
+_SNAPSHOT_HEADER = struct.Struct('<8s14i')
+_AGENT_RECORD = np.dtype([('kind', '<i4'), ('i', '<i4'), ('j', '<i4'), ('energy', '<i4'),
+                          ('max_energy', '<i4'), ('be_cost', '<i4'), ('eat_cost', '<i4'),
+                          ('move_cost', '<i4'), ('action_cost', '<i4')])
+
+class Grid(object):
+    """Array-backed storage of every cell field, one contiguous array per field.
+
+    An incremental grid also keeps a dirty set of the cells whose newly food dropped to zero since
+    the last tick, so that a tick only has to look at the cells that actually changed.
+
+    Once a capacity is set the grid also indexes the cells whose newly food is under it, the
+    indexed cells are packed at the front of free and slot maps a cell back to its position there.
+    """
+    def __init__(self, height, width, incremental=False, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+        self.height = height
+        self.width = width
+        self.newly = np.zeros((height, width), dtype=np.int32)
+        self.stored = np.zeros((height, width), dtype=np.int32)
         #TODO(@khalil): Discuss this matter and see how energy food provides should be calculated.
-        self._energy = random.randint(1, 10)
+        self.energy = rng.integers(1, 10, size=(height, width), dtype=np.int32, endpoint=True)
+        self.seeded = np.zeros((height, width), dtype=np.bool_)
+        self.dirty = set() if incremental else None
+        self.capacity = None
+        self.free = np.empty(height * width, dtype=np.int32)
+        self.nfree = 0
+        self.slot = np.full(height * width, -1, dtype=np.int32)
+
+    @classmethod
+    def from_arrays(cls, newly, stored, energy, seeded, free, slot, nfree, capacity,
+                    incremental=False):
+        """Build a grid over existing arrays, such as the ones of a snapshot, without copying."""
+        grid = cls.__new__(cls)
+        grid.height, grid.width = newly.shape
+        grid.newly = newly
+        grid.stored = stored
+        grid.energy = energy
+        grid.seeded = seeded
+        grid.dirty = set() if incremental else None
+        grid.capacity = capacity
+        grid.free = free
+        grid.nfree = nfree
+        grid.slot = slot
+        grid.track()
+        return grid
+
+    def track(self):
+        """Mark every cell that is currently empty and not seeded as dirty."""
+        if self.dirty is not None:
+            self.dirty.update(map(tuple, np.argwhere((self.newly == 0) & ~self.seeded).tolist()))
+
+    def newly_at(self, i, j):
+        """Get the newly produced food of cell (i, j)."""
+        return int(self.newly[i, j])
+
+    def stored_at(self, i, j):
+        """Get the stored food of cell (i, j)."""
+        return int(self.stored[i, j])
+
+    def energy_at(self, i, j):
+        """Get the energy the food of cell (i, j) provides."""
+        return int(self.energy[i, j])
+
+    def seeded_at(self, i, j):
+        """Tells whether cell (i, j) already seeded since its newly food ran out."""
+        return bool(self.seeded[i, j])
+
+    def set_seeded(self, i, j, seeded):
+        """Set whether cell (i, j) already seeded."""
+        self.seeded[i, j] = seeded
+
+    def materialize(self):
+        """Returns a grid owning arrays with the current state, a plain grid already does."""
+        return self
+
+    def set_capacity(self, capacity):
+        """Rebuild the index of free cells for a new production capacity."""
+        self.capacity = capacity
+        cells = np.flatnonzero(self.newly.reshape(-1) < capacity)
+        self.nfree = len(cells)
+        self.free[:self.nfree] = cells
+        self.slot.fill(-1)
+        self.slot[cells] = np.arange(self.nfree)
+
+    def _index(self, cell):
+        if self.slot[cell] < 0:
+            self.free[self.nfree] = cell
+            self.slot[cell] = self.nfree
+            self.nfree = self.nfree + 1
+
+    def _unindex(self, cell):
+        position = self.slot[cell]
+        if position >= 0:
+            # the last indexed cell takes the place of the removed one.
+            self.nfree = self.nfree - 1
+            last = self.free[self.nfree]
+            self.free[position] = last
+            self.slot[last] = position
+            self.slot[cell] = -1
+
+    def sample_free(self, rng):
+        """Returns a random (i, j) among the cells under capacity, None when there is none."""
+        if self.nfree == 0:
+            return None
+        return divmod(int(self.free[rng.integers(self.nfree)]), self.width)
+
+    def produce(self, i, j, quantitiy):
+        """Add quantity to the newly produced food of cell (i, j)."""
+        self.newly[i, j] += quantitiy
+        if self.capacity is not None and self.newly[i, j] >= self.capacity:
+            self._unindex(i * self.width + j)
+
+    def store(self, i, j, quantitiy):
+        """Add quantity to the stored food of cell (i, j)."""
+        self.stored[i, j] += quantitiy
+
+    def consume(self, i, j):
+        """Remove one unit of stored food from cell (i, j)."""
+        self.stored[i, j] -= 1
+
+    def decrease_newly(self, i, j, quantitiy):
+        """Remove quantity from the newly produced food of cell (i, j)."""
+        self.newly[i, j] -= quantitiy
+        if self.capacity is not None and self.newly[i, j] < self.capacity:
+            self._index(i * self.width + j)
+        if self.dirty is not None and self.newly[i, j] == 0 and not self.seeded[i, j]:
+            self.dirty.add((i, j))
+
+    def emptied(self):
+        """Returns, in row order, the cells whose newly food ran out and that did not seed yet.
+
+        An incremental grid hands out its dirty set and starts a fresh one, a full grid scans every
+        cell with a single mask.
+        """
+        if self.dirty is not None:
+            cells = sorted(self.dirty)
+            self.dirty.clear()
+            return cells
+        return np.argwhere((self.newly == 0) & ~self.seeded).tolist()
+
+class ForkedGrid(object):
+    """Copy-on-write grid sharing a frozen base Grid with the other forks of the same world.
+
+    Cells a fork writes to are copied into its own overlay of (newly, stored, seeded) tuples and
+    everything else is read from the base, so forking only copies the overlay, the dirty set and
+    the cells that became free since the base was frozen. A forked grid always tracks dirty cells
+    so a tick never has to scan the base. Once the overlay holds more than a quarter of the grid,
+    the next tick, season change or fork freezes the current state into a new base.
+
+    The free-capacity index is kept lazily: candidates of the base index and of added are only
+    checked against the capacity when sampled.
+    """
+    def __init__(self, base):
+        self.height = base.height
+        self.width = base.width
+        self.capacity = base.capacity
+        self._base = base
+        self._cells = {}
+        self._free = base.free[:base.nfree]
+        self._slot = base.slot
+        self._added = []
+        self._marked = set()
+        if base.dirty is not None:
+            self.dirty = set(base.dirty)
+        else:
+            self.dirty = set(map(tuple, np.argwhere((base.newly == 0) & ~base.seeded).tolist()))
+
+    def fork(self):
+        """Returns a new fork seeing the same cells as this one."""
+        if self._crowded():
+            self._rebase()
+        fork = copy.copy(self)
+        fork._cells = dict(self._cells)
+        fork._added = list(self._added)
+        fork._marked = set(self._marked)
+        fork.dirty = set(self.dirty)
+        return fork
+
+    def _crowded(self):
+        # once the overlay got large the current state is frozen into a new base, so that forks
+        # stay cheap and reads go back to hitting the arrays.
+        return len(self._cells) > self.height * self.width // 4
+
+    def _rebase(self):
+        base = self.materialize()
+        self._base = base
+        self._cells = {}
+        self._free = base.free[:base.nfree]
+        self._slot = base.slot
+        self._added = []
+        self._marked = set()
+
+    def materialize(self):
+        """Returns a plain grid owning a copy of the current state."""
+        size = self.height * self.width
+        grid = Grid.from_arrays(self.newly, self.stored, self._base.energy, self.seeded,
+                                np.empty(size, dtype=np.int32), np.full(size, -1, dtype=np.int32),
+                                0, None)
+        grid.set_capacity(self.capacity)
+        return grid
+
+    def _cell(self, i, j):
+        cell = self._cells.get(i * self.width + j)
+        if cell is None:
+            base = self._base
+            cell = (int(base.newly[i, j]), int(base.stored[i, j]), bool(base.seeded[i, j]))
+        return cell
+
+    @property
+    def newly(self):
+        """Get a copy of the newly produced food of every cell."""
+        return self._field(self._base.newly, 0)
+
+    @property
+    def stored(self):
+        """Get a copy of the stored food of every cell."""
+        return self._field(self._base.stored, 1)
+
+    @property
+    def energy(self):
+        """Get the energy of every cell, energies never change so forks share them."""
+        return self._base.energy
+
+    @property
+    def seeded(self):
+        """Get a copy of the seeded flag of every cell."""
+        return self._field(self._base.seeded, 2)
+
+    def _field(self, array, field):
+        array = array.copy()
+        flat = array.reshape(-1)
+        for cell, values in self._cells.items():
+            flat[cell] = values[field]
+        return array
+
+    def newly_at(self, i, j):
+        """Get the newly produced food of cell (i, j)."""
+        return self._cell(i, j)[0]
+
+    def stored_at(self, i, j):
+        """Get the stored food of cell (i, j)."""
+        return self._cell(i, j)[1]
+
+    def energy_at(self, i, j):
+        """Get the energy the food of cell (i, j) provides."""
+        return int(self._base.energy[i, j])
+
+    def seeded_at(self, i, j):
+        """Tells whether cell (i, j) already seeded since its newly food ran out."""
+        return self._cell(i, j)[2]
+
+    def set_seeded(self, i, j, seeded):
+        """Set whether cell (i, j) already seeded."""
+        newly, stored, _ = self._cell(i, j)
+        self._cells[i * self.width + j] = (newly, stored, seeded)
+
+    def produce(self, i, j, quantitiy):
+        """Add quantity to the newly produced food of cell (i, j)."""
+        newly, stored, seeded = self._cell(i, j)
+        self._cells[i * self.width + j] = (newly + quantitiy, stored, seeded)
+
+    def store(self, i, j, quantitiy):
+        """Add quantity to the stored food of cell (i, j)."""
+        newly, stored, seeded = self._cell(i, j)
+        self._cells[i * self.width + j] = (newly, stored + quantitiy, seeded)
+
+    def consume(self, i, j):
+        """Remove one unit of stored food from cell (i, j)."""
+        self.store(i, j, -1)
+
+    def decrease_newly(self, i, j, quantitiy):
+        """Remove quantity from the newly produced food of cell (i, j)."""
+        newly, stored, seeded = self._cell(i, j)
+        newly = newly - quantitiy
+        cell = i * self.width + j
+        self._cells[cell] = (newly, stored, seeded)
+        if newly < self.capacity and self._slot[cell] < 0 and cell not in self._marked:
+            self._added.append(cell)
+            self._marked.add(cell)
+        if newly == 0 and not seeded:
+            self.dirty.add((i, j))
+
+    def track(self):
+        """A forked grid always tracks its dirty cells."""
+
+    def emptied(self):
+        """Returns, in row order, the cells whose newly food ran out and that did not seed yet."""
+        if self._crowded():
+            # every tick goes through here, a grid that keeps stepping never outgrows its overlay.
+            self._rebase()
+        cells = sorted(self.dirty)
+        self.dirty.clear()
+        return cells
+
+    def set_capacity(self, capacity):
+        """Rebuild the index of free cells for a new production capacity."""
+        self.capacity = capacity
+        if self._crowded():
+            # the new base gets its index built for the new capacity.
+            self._rebase()
+            return
+        cells = np.flatnonzero(self.newly.reshape(-1) < capacity).astype(np.int32)
+        self._free = cells
+        self._slot = np.full(self.height * self.width, -1, dtype=np.int32)
+        self._slot[cells] = np.arange(len(cells))
+        self._added = []
+        self._marked = set()
+
+    def sample_free(self, rng):
+        """Returns a random (i, j) among the cells under capacity, None when there is none."""
+        candidates = len(self._free) + len(self._added)
+        if candidates == 0:
+            return None
+        for _ in range(32):
+            k = int(rng.integers(candidates))
+            cell = int(self._free[k]) if k < len(self._free) else self._added[k - len(self._free)]
+            i, j = divmod(cell, self.width)
+            if self._cell(i, j)[0] < self.capacity:
+                return i, j
+        # most candidates went stale, pick among the ones that are still free.
+        free = [divmod(cell, self.width) for cell in self._free.tolist() + self._added]
+        free = [(i, j) for i, j in free if self._cell(i, j)[0] < self.capacity]
+        if not free:
+            return None
+        return free[int(rng.integers(len(free)))]
+
+class Occupancy(object):
+    """Spatial index of the agents of an environment, every agent is listed under its cell.
+
+    Agents register themselves when they are created and update their entry as they move, so that
+    the agents on a cell or around it are found without walking every agent.
+    """
+    def __init__(self, width):
+        self._width = width
+        self._cells = {}
+
+    def add(self, agent):
+        """List the agent under its current cell."""
+        self._cells.setdefault(agent.i * self._width + agent.j, []).append(agent)
+
+    def remove(self, agent):
+        """Forget the agent, it must still be on the cell it was listed under."""
+        cell = agent.i * self._width + agent.j
+        agents = self._cells[cell]
+        agents.remove(agent)
+        if not agents:
+            del self._cells[cell]
+
+    def move(self, agent, i, j):
+        """List the agent under (i, j) instead, called before the agent updates its position."""
+        self.remove(agent)
+        self._cells.setdefault(i * self._width + j, []).append(agent)
+
+    def at(self, i, j):
+        """Returns the agents on the cell (i, j) in the order they got there."""
+        return tuple(self._cells.get(i * self._width + j, ()))
+
+    def count(self, i, j):
+        """Returns the number of agents on the cell (i, j)."""
+        return len(self._cells.get(i * self._width + j, ()))
+
+    def around(self, i, j, radius):
+        """Returns the agents at most radius moves away from (i, j), the cell itself included.
+
+        Moves go in the eight directions so the neighbourhood is a square. It is walked cell by
+        cell unless it holds more cells than there are occupied ones.
+        """
+        agents = []
+        if (2 * radius + 1) ** 2 > len(self._cells):
+            for cell, occupants in self._cells.items():
+                celli, cellj = divmod(cell, self._width)
+                if abs(celli - i) <= radius and abs(cellj - j) <= radius:
+                    agents.extend(occupants)
+            return agents
+
+        for celli in range(max(i - radius, 0), i + radius + 1):
+            for cellj in range(max(j - radius, 0), min(j + radius + 1, self._width)):
+                agents.extend(self._cells.get(celli * self._width + cellj, ()))
+        return agents
+
+class Cell(object):
+    """Environment's representation of cell with the newly and stored food.
+
+    A cell is a thin view over one position of a Grid. A cell built without a grid gets a 1x1
+    grid of its own so it can still be used standalone.
+    """
+    __slots__ = ('_grid', '_i', '_j')
+
+    def __init__(self, grid=None, i=0, j=0):
+        if grid is None:
+            grid = Grid(1, 1)
+        self._grid = grid
+        self._i = i
+        self._j = j
 
     def get_newly(self):
         """Get newly."""
-        return self._newly
+        return self._grid.newly_at(self._i, self._j)
 
     def get_stored(self):
         """Get stored."""
-        return self._stored
+        return self._grid.stored_at(self._i, self._j)
 
     def produce(self, quantitiy):
         """Add quantity to the ammount of newly produced food."""
-        self._newly = self._newly + quantitiy
+        self._grid.produce(self._i, self._j, quantitiy)
 
     def store(self, quantitiy):
         """Add ammount quantity to the stored food."""
-        self._stored = self._stored + quantitiy
+        self._grid.store(self._i, self._j, quantitiy)
 
     def consume(self):
         """Agents can eat food and thus decrease ammount of stored food."""
-        self._stored = self._stored - 1
+        self._grid.consume(self._i, self._j)
 
     def decrease_newly(self, quantitiy):
         """Decrease the newly by the giving quantity."""
-        self._newly = self._newly - quantitiy
+        self._grid.decrease_newly(self._i, self._j, quantitiy)
 
     def get_food_energy(self):
         """Get energy."""
-        return self._energy
+        return self._grid.energy_at(self._i, self._j)
 
 class Environment(object):
-    """Environment generated and interface for interaction."""
-    def __init__(self, height, width, cycle, food_per_season):
+    """Environment generated and interface for interaction.
+
+    Every environment owns its random generator built from seed, agents and anything else living in
+    the environment get independent generators split off it with spawn.
+    """
+    def __init__(self, height, width, cycle, food_per_season, incremental=False, seed=None):
         self._height = height
         self._width = width
         self._cycle = cycle
-        self._env = [[Cell() for j in range(self._height)] for i in range(self._height)]
-        self._seeded = [[False for j in range(self._height)] for i in range(self._height)]
+        self._seed = np.random.SeedSequence(seed)
+        self._rng = np.random.default_rng(self._seed)
+        self._grid = Grid(self._height, self._width, incremental, self._rng)
+        self._occupancy = Occupancy(self._width)
         self._t = 0
         self._season = Season.SPRING
         self._food_per_season = food_per_season
+        # None outside of a round, inside one it tells whether an action asked for a tick.
+        self._round = None
 
         self._generate_init_env()
+        self._grid.track()
+        self._grid.set_capacity(self._food_per_season[self._season.value])
 
     def _generate_init_env(self):
-
-        production_cap = random.randint(1, self._height * self._width)
-
-        for i in range(self._height):
-            if production_cap == 0:
-                break
-            for j in range(self._width):
-                if production_cap == 0:
-                    break
-
-                cell = self._env[i][j]
-
-                if cell.get_newly() == self._food_per_season[self._season.value]:
-                    continue
-
-                should_fill = random.randint(0, 1)
-                if not should_fill:
-                    continue
-
-                production_cap = production_cap - 1
-                quantitiy = random.randint(
-                    0,
-                    self._food_per_season[self._season.value] - cell.get_newly()
-                )
-                cell.produce(quantitiy)
-
+        size = self._height * self._width
+        food = self._food_per_season[self._season.value]
+        newly = self._grid.newly.reshape(size)
+
+        production_cap = self._rng.integers(1, size, endpoint=True)
+
+        # Cells get a coin flip each and the winners are filled in row order until the production
+        # cap is reached.
+        should_fill = (self._rng.integers(0, 1, size=size, endpoint=True) == 1) & (newly != food)
+        should_fill &= np.cumsum(should_fill) <= production_cap
+        quantitiy = self._rng.integers(0, food - newly, endpoint=True)
+        newly += np.where(should_fill, quantitiy, 0).astype(np.int32)
+
+    def spawn(self):
+        """Returns a new random generator independent from the environment's own stream."""
+        return np.random.default_rng(self._seed.spawn(1)[0])
+
+    @contextlib.contextmanager
+    def round(self):
+        """Play several actions as one round: the environment ticks once when the round closes.
+
+        Actions taken inside the round still call simulate, the ticks they ask for are merged into
+        a single one that only happens if at least one of them went through.
+        """
+        self._round = False
+        try:
+            yield self
+        finally:
+            ticked = self._round
+            self._round = None
+            if ticked:
+                self._tick()
 
     def simulate(self):
         """One unit of time simulation."""
+        if instrument.stats is not None:
+            # every action that went through asks for a tick.
+            instrument.stats.count('actions.played')
+        if self._round is not None:
+            self._round = True
+            return
+        self._tick()
+
+    def _tick(self):
+        stats = instrument.stats
+        if stats is not None:
+            start = instrument.now()
+
         self._t = self._t + 1
         if self._t == self._cycle:
             # End of a season, start of the next one. Year is also cyclic that is WINTER -> SPRING.
             self._t = 0
             self._season = self._season.next()
+            self._grid.set_capacity(self._food_per_season[self._season.value])
 
         # When the ammount of newly produced food in a cell is over and the cell can seed we
         # randomly choose another spot where some random ammount of newly produced food should
         # be stored.
-        for i in range(self._height):
-            for j in range(self._width):
-                if self._env[i][j].get_newly() == 0 and not self._seeded[i][j]:
-                    # if the cell become empty just now seed in once in a randomn cell on the grid.
-                    self._seeded[i][j] = True
-                    cap = self._height + self._width
-                    while cap > 0:
-                        seedi = random.randint(0, self._height - 1)
-                        seedj = random.randint(0, self._width - 1)
-
-                        production_cap = self._food_per_season[self._season.value]
-
-                        production_cap -= self._env[seedi][seedj].get_newly()
-
-                        if production_cap > 0:
-                            seed_amount = random.randint(1, production_cap)
-                            self._env[seedi][seedj].produce(seed_amount)
-                            self._seeded[seedi][seedj] = False
-                            break
-
-                        cap = cap - 1
+        grid = self._grid
+        production_cap = self._food_per_season[self._season.value]
+        emptied = grid.emptied()
+        if stats is not None:
+            scanned = instrument.now()
+            stats.add('simulate.scan', scanned - start)
+            attempts = seeds = 0
+
+        for i, j in emptied:
+            if grid.newly_at(i, j) != 0 or grid.seeded_at(i, j):
+                # an earlier cell of this same tick already seeded into this one.
+                continue
+            # if the cell become empty just now seed in once in a randomn cell on the grid that
+            # still has room for this season.
+            grid.set_seeded(i, j, True)
+            if stats is not None:
+                attempts += 1
+            spot = grid.sample_free(self._rng)
+            if spot is None:
+                continue
+            seedi, seedj = spot
+            seed_amount = int(self._rng.integers(1, production_cap - grid.newly_at(seedi, seedj),
+                                                 endpoint=True))
+            grid.produce(seedi, seedj, seed_amount)
+            grid.set_seeded(seedi, seedj, False)
+            if stats is not None:
+                seeds += 1
+
+        if stats is not None:
+            end = instrument.now()
+            stats.add('simulate.seed', end - scanned)
+            stats.add('simulate', end - start)
+            stats.count('simulate.emptied', len(emptied))
+            stats.count('simulate.seed_attempts', attempts)
+            stats.count('simulate.seeds', seeds)
 
     @property
     def height(self):
@@ -138,12 +582,125 @@ class Environment(object):
         """Get width."""
         return self._width
 
+    @property
+    def grid(self):
+        """Get the array-backed grid the cells are views over."""
+        return self._grid
+
+    @property
+    def occupancy(self):
+        """Get the spatial index of the agents living in the environment."""
+        return self._occupancy
+
     def get_cell(self, i, j):
         """returns the cell at provided position."""
-        return self._env[i][j]
+        return Cell(self._grid, i, j)
+
+    def agents_at(self, i, j):
+        """Returns the agents on the cell at provided position."""
+        return self._occupancy.at(i, j)
+
+    def agents_around(self, i, j, radius):
+        """Returns the agents at most radius moves away from the provided position."""
+        return self._occupancy.around(i, j, radius)
+
+    def fork(self, agents=()):
+        """Returns a copy of the environment and of the given agents to explore moves on.
+
+        Cell storage is shared copy-on-write: the first fork freezes the current grid, after which
+        this environment and all its forks only copy the cells they mutate. Agents are small fixed
+        records and only the ones passed in are copied, friendships among them are kept.
+        """
+        if not isinstance(self._grid, ForkedGrid):
+            self._grid = ForkedGrid(self._grid)
+
+        env = copy.copy(self)
+        # a fork taken inside a round is not part of it and ticks on its own.
+        env._round = None
+        env._seed = self._seed.spawn(1)[0]
+        env._rng = np.random.default_rng(env._seed)
+        env._grid = self._grid.fork()
+        env._occupancy = Occupancy(self._width)
+
+        forks = {id(agent): agent.fork(env) for agent in agents}
+        for agent in forks.values():
+            if isinstance(agent, GrassHoper):
+                agent._friends = {forks.get(id(friend), friend) for friend in agent._friends}
+        return env, list(forks.values())
+
+    def save(self, path, agents=()):
+        """Write the environment and the given agents to a snapshot file at path."""
+        grid = self._grid.materialize()
+        records = np.array([agent.record() for agent in agents], dtype=_AGENT_RECORD)
+        header = _SNAPSHOT_HEADER.pack(
+            _SNAPSHOT_MAGIC, self._height, self._width, self._cycle, self._t, self._season.value,
+            *self._food_per_season, grid.capacity, grid.nfree, len(records),
+            grid.dirty is not None, 0)
+        with open(path, 'wb') as snapshot:
+            snapshot.write(header)
+            for array in (grid.newly, grid.stored, grid.energy, grid.free, grid.slot):
+                snapshot.write(array.astype('<i4', copy=False).tobytes())
+            seeded = grid.seeded.astype(np.uint8).tobytes()
+            # pad so that the agent records stay 4-byte aligned.
+            snapshot.write(seeded + b'\0' * (-len(seeded) % 4))
+            snapshot.write(records.tobytes())
+
+    @staticmethod
+    def load(path, seed=None):
+        """Map a snapshot written by save and returns the environment and its agents.
+
+        The grid arrays are copy-on-write views over the mapped file: nothing is parsed or copied
+        up front and every environment loaded from the same snapshot shares the untouched pages.
+        The random generator is not part of the snapshot, seed gives the loaded environment its own.
+        """
+        with open(path, 'rb') as snapshot:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_COPY)
+        (magic, height, width, cycle, t, season, spring, summer, fall, winter, capacity, nfree,
+         nagents, incremental, _) = _SNAPSHOT_HEADER.unpack_from(mapped)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError('%s is not an environment snapshot' % path)
+
+        size = height * width
+        offset = _SNAPSHOT_HEADER.size
+        arrays = []
+        for _ in range(5):
+            arrays.append(np.frombuffer(mapped, dtype=np.int32, count=size, offset=offset))
+            offset = offset + 4 * size
+        newly, stored, energy, free, slot = arrays
+        seeded = np.frombuffer(mapped, dtype=np.bool_, count=size, offset=offset)
+        offset = offset + size + (-size % 4)
+        records = np.frombuffer(mapped, dtype=_AGENT_RECORD, count=nagents, offset=offset)
+
+        env = Environment.__new__(Environment)
+        env._height = height
+        env._width = width
+        env._cycle = cycle
+        env._seed = np.random.SeedSequence(seed)
+        env._rng = np.random.default_rng(env._seed)
+        env._grid = Grid.from_arrays(
+            newly.reshape(height, width), stored.reshape(height, width),
+            energy.reshape(height, width), seeded.reshape(height, width), free, slot, nfree,
+            capacity, bool(incremental))
+        env._occupancy = Occupancy(width)
+        env._t = t
+        env._season = Season(season)
+        env._food_per_season = [spring, summer, fall, winter]
+        env._round = None
+
+        agents = []
+        for record in records.tolist():
+            kind, i, j, energy, max_energy, be_cost, eat_cost, move_cost, action_cost = record
+            agent = (Ant, GrassHoper)[kind](max_energy, energy, env, be_cost, eat_cost, move_cost,
+                                            action_cost)
+            agent._place(i, j)
+            agents.append(agent)
+        return env, agents
 
 class Agent(object):
     """Parent class for every type of agent present in our environment."""
+    __slots__ = ('_max_energy', '_energy', '_be_cost', '_eat_cost', '_move_cost', '_env', '_rng',
+                 '_i', '_j')
+
     def __init__(self, max_energy, initial_energy, env, be_cost, eat_cost, move_cost):
         self._max_energy = max_energy
         self._energy = initial_energy
@@ -153,8 +710,10 @@ class Agent(object):
         self._move_cost = move_cost
 
         self._env = env
-        self._i = random.randint(0, env.height - 1)
-        self._j = random.randint(0, env.width - 1)
+        self._rng = env.spawn()
+        self._i = int(self._rng.integers(0, env.height))
+        self._j = int(self._rng.integers(0, env.width))
+        env.occupancy.add(self)
 
     @property
     def i(self):
@@ -166,22 +725,50 @@ class Agent(object):
         """Get j."""
         return self._j
 
+    @property
+    def energy(self):
+        """Get energy."""
+        return self._energy
+
     def show(self):
         """Returns what the agent can see and depends on what type of agent."""
         raise NotImplementedError
 
+    def record(self):
+        """Returns the agent as a row of the snapshot agent records."""
+        raise NotImplementedError
+
+    def fork(self, env):
+        """Returns a copy of the agent living in env, a fork of its environment."""
+        agent = copy.copy(self)
+        agent._env = env
+        agent._rng = env.spawn()
+        env.occupancy.add(agent)
+        return agent
+
+    def _place(self, i, j):
+        self._env.occupancy.move(self, i, j)
+        self._i = i
+        self._j = j
+
+    def neighbours(self, radius):
+        """Returns the other agents at most radius moves away."""
+        return [agent for agent in self._env.agents_around(self._i, self._j, radius)
+                if agent is not self]
+
     def move(self, deltai, deltaj):
         """Agent moves in one of the eight 2-d directions with sanity checking of new postition."""
         if abs(deltai) > 1 or abs(deltaj) > 1:
             return
         if self._i + deltai >= self._env.height or self._j + deltaj >= self._env.width:
             return
+        if self._i + deltai < 0 or self._j + deltaj < 0:
+            return
 
         if self._energy < self._move_cost:
             return
 
-        self._i = self._i + deltai
-        self._j = self._j + deltaj
+        self._place(self._i + deltai, self._j + deltaj)
 
         self._energy = self._energy - self._move_cost
 
@@ -212,24 +799,35 @@ class Agent(object):
 
 class GrassHoper(Agent):
     """GrassHoper agent type who has ability to sing."""
+    __slots__ = ('_sing_cost', '_friends')
+
     def __init__(self, max_energy, initial_energy, env, be_cost, eat_cost, move_cost, sing_cost):
         super().__init__(max_energy, initial_energy, env, be_cost, eat_cost, move_cost)
         self._sing_cost = sing_cost
-        # Friends is a given list of ants that we made friendship with and can help us by singing.
-        self._friends = []
+        # Friends is a given set of ants that we made friendship with and can help us by singing.
+        self._friends = set()
 
     def show(self):
         return {'stored': self.show_stored()}
 
+    def record(self):
+        # Friends are references to other agents and are not part of the snapshot.
+        return (1, self._i, self._j, self._energy, self._max_energy, self._be_cost,
+                self._eat_cost, self._move_cost, self._sing_cost)
+
     def show_stored(self):
         """Show the number of stored food on the current cell."""
         return self._env.get_cell(self._i, self._j).get_stored()
 
 
+    def befriend(self, ant):
+        """Make friendship with an ant so that it answers our calls."""
+        self._friends.add(ant)
+
     def call(self, i, j):
         """Friendship is so powerful calling friends doesn't use energy. It only takes gratitude."""
-        for ant in self._friends:
-            if ant.i == i and ant.j == j:
+        for ant in self._env.agents_at(i, j):
+            if ant in self._friends:
                 ant.forage()
 
 
@@ -243,6 +841,8 @@ class GrassHoper(Agent):
 
 class Ant(Agent):
     """The ant agent and its access API."""
+    __slots__ = ('_forage_cost',)
+
     def __init__(self, max_energy, initial_energy, env, be_cost, eat_cost, move_cost, forage_cost):
         super().__init__(max_energy, initial_energy, env, be_cost, eat_cost, move_cost)
         self._forage_cost = forage_cost
@@ -250,6 +850,10 @@ class Ant(Agent):
     def show(self):
         return {'stored': self.show_stored(), 'newly': self.show_newly()}
 
+    def record(self):
+        return (0, self._i, self._j, self._energy, self._max_energy, self._be_cost,
+                self._eat_cost, self._move_cost, self._forage_cost)
+
     def show_newly(self):
         """Show the number of newly produces food on the current cell."""
         return self._env.get_cell(self._i, self._j).get_newly()
@@ -271,7 +875,7 @@ class Ant(Agent):
         self._energy = self._energy - self._forage_cost
         self._env.simulate()
 
-def parse():
+def parse(argv=None):
     """Parse command line args to get constants for the environment and agents."""
     parser = argparse.ArgumentParser(conflict_handler='resolve')
 
@@ -288,6 +892,8 @@ def parse():
     parser.add_argument('-h', '--height', type=int, default=5, help='height of the 2-d environment')
     parser.add_argument('-c', '--cycle', type=int, default=10,
                         help='seasonnal cycle length of the environment')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='only look at the cells that changed when simulating a tick')
 
     # Agent specific control flags.
     parser.add_argument('-e', '--energy', type=int, default=20,
@@ -305,7 +911,21 @@ def parse():
     parser.add_argument('-p', '--population', type=int, default=2,
                         help='number of living creatures inside our universe')
 
-    args = parser.parse_args()
+    # Rollout specific control flags.
+    parser.add_argument('-n', '--episodes', type=int, default=1,
+                        help='number of episodes to roll out')
+    parser.add_argument('-t', '--steps', type=int, default=1000,
+                        help='maximum number of rounds in an episode')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes, every core of the machine by default')
+    parser.add_argument('-seed', '--seed', type=int, default=0,
+                        help='seed of the first episode, episode k is seeded with seed + k')
+    parser.add_argument('-workers', '--workers', type=int, default=None,
+                        help='threads deciding the actions of the agents in parallel every round')
+    parser.add_argument('-profile', '--profile', action='store_true',
+                        help='record timings and counters of every episode into its stats')
+
+    args = parser.parse_args(argv)
     return args
 
 def init():
@@ -314,4 +934,8 @@ def init():
     return env
 
 if __name__ == '__main__':
-    parse()
+    import json
+    import rollout
+
+    for stats in rollout.run(parse()):
+        print(json.dumps(stats))
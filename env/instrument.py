@@ -0,0 +1,51 @@
+""" Opt-in timings and counters of the env.py hot paths.
+
+Instrumentation is off until enable is called. env.py only checks whether stats is None before
+recording anything, so a disabled run pays one global lookup per tick and per action.
+"""
+import collections
+import time
+
+# The Stats being recorded into, None when instrumentation is disabled.
+stats = None
+
+# Clock of every timing.
+now = time.perf_counter
+
+class Stats(object):
+    """Total time spent in every named phase and running counters."""
+    def __init__(self):
+        self.timings = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        self.counters = collections.Counter()
+
+    def add(self, name, seconds):
+        """Record one run of phase name that took seconds."""
+        timing = self.timings[name]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    def count(self, name, n=1):
+        """Add n to the counter name."""
+        self.counters[name] += n
+
+    def snapshot(self):
+        """Returns everything recorded so far as plain dicts, times in milliseconds."""
+        timings = {
+            name: {'count': count, 'total_ms': 1000 * total, 'mean_ms': 1000 * total / count,
+                   'max_ms': 1000 * longest}
+            for name, (count, total, longest) in self.timings.items()
+        }
+        return {'timings': timings, 'counters': dict(self.counters)}
+
+def enable():
+    """Start recording into fresh stats and returns them."""
+    global stats
+    stats = Stats()
+    return stats
+
+def disable():
+    """Stop recording, returns what was recorded."""
+    global stats
+    recorded, stats = stats, None
+    return recorded
@@ -0,0 +1,94 @@
+""" Local views of the grid for many agents at once.
+
+An Observer cuts the k x k window centred on every agent out of the newly food, the stored food and
+the number of agents of every cell, and writes them all into one preallocated array of shape
+(agents, CHANNELS, k, k). Windows are gathered straight from the grid with clipped indices and the
+cells off the grid masked afterwards, so a call costs agents * k * k whatever the size of the grid,
+and there is no per agent Python work besides reading the agent positions.
+"""
+import numpy as np
+
+from env import Ant
+
+# Channels of an observation.
+NEWLY = 0
+STORED = 1
+OCCUPANCY = 2
+CHANNELS = 3
+
+# Value of what the agent cannot see: cells off the grid and the newly food for grasshopers.
+MASKED = -1
+
+class Observer(object):
+    """k x k windows centred on agents of one or several worlds of the same shape.
+
+    The array returned by observe is reused by the next call, copy it to keep it around.
+    """
+    def __init__(self, height, width, k, worlds=1, capacity=0):
+        if k % 2 == 0:
+            raise ValueError('window size must be odd, got {}'.format(k))
+        self._height = height
+        self._width = width
+        self._k = k
+        self._worlds = worlds
+        # Rows, and columns, of a window relative to the agent it is centred on.
+        self._window = np.arange(k) - k // 2
+        # Number of agents of every cell, only the cells of the agents observed are set, and reset
+        # once their windows are gathered.
+        self._occupancy = np.zeros(worlds * height * width, dtype=np.int32)
+        self._out = np.empty((capacity, CHANNELS, k, k), dtype=np.int32)
+
+    @property
+    def k(self):
+        """Get the window size."""
+        return self._k
+
+    def observe(self, newly, stored, i, j, ants, world=None):
+        """Returns the windows centred on the agents at (i, j), one row per agent.
+
+        newly and stored hold the grid of every world, shaped (worlds, height, width) or
+        (height, width) for a single world, and world tells the world of every agent. ants tells
+        whether every agent is an ant, the others do not see the newly food.
+        """
+        i = np.asarray(i, dtype=np.intp)
+        j = np.asarray(j, dtype=np.intp)
+        world = np.zeros_like(i) if world is None else np.asarray(world, dtype=np.intp)
+        n = len(i)
+        if n > len(self._out):
+            self._out = np.empty((n, CHANNELS, self._k, self._k), dtype=np.int32)
+        out = self._out[:n]
+        if n == 0:
+            return out
+
+        rows = i[:, None] + self._window
+        cols = j[:, None] + self._window
+        off = ((rows < 0) | (rows >= self._height))[:, :, None] | \
+            ((cols < 0) | (cols >= self._width))[:, None, :]
+        # off grid cells read the nearest cell of the grid, they are masked once gathered.
+        rows = np.clip(rows, 0, self._height - 1) + (world * self._height)[:, None]
+        cols = np.clip(cols, 0, self._width - 1)
+        index = rows[:, :, None] * self._width + cols[:, None, :]
+        np.take(np.asarray(newly, dtype=np.int32).reshape(-1), index, out=out[:, NEWLY])
+        np.take(np.asarray(stored, dtype=np.int32).reshape(-1), index, out=out[:, STORED])
+
+        cell = (world * self._height + i) * self._width + j
+        np.add.at(self._occupancy, cell, 1)
+        np.take(self._occupancy, index, out=out[:, OCCUPANCY])
+        self._occupancy[cell] = 0
+
+        np.copyto(out, MASKED, where=off[:, None])
+        out[:, NEWLY][~np.asarray(ants, dtype=np.bool_)] = MASKED
+        return out
+
+    def agents(self, env, agents):
+        """Returns the windows of env.py agents living in env, in the order of agents."""
+        n = len(agents)
+        i = np.fromiter((agent.i for agent in agents), dtype=np.intp, count=n)
+        j = np.fromiter((agent.j for agent in agents), dtype=np.intp, count=n)
+        ants = np.fromiter((isinstance(agent, Ant) for agent in agents), dtype=np.bool_, count=n)
+        return self.observe(env.grid.newly, env.grid.stored, i, j, ants)
+
+    def vector(self, venv):
+        """Returns the windows of the agent of every world of a VectorEnvironment."""
+        i, j = venv.positions
+        return self.observe(venv.newly, venv.stored, i, j, venv.ants, np.arange(venv.n))
@@ -0,0 +1,73 @@
+""" Headless rollouts of env.py populations spread over a pool of worker processes.
+
+Each episode builds an Environment and its population of ants and grasshopers from the command line
+arguments of env.parse, then lets every living agent play a random action each round until everyone
+is dead or the round limit is reached. Rounds are played by a Scheduler, so the world ticks once per
+round whatever the size of the population.
+"""
+import functools
+import multiprocessing
+
+from env import Ant, Environment, GrassHoper
+import instrument
+from scheduler import Scheduler
+
+def build(args, seed=None):
+    """Create the environment and its population from the parsed command line arguments."""
+    food_per_season = [args.spring_threshold, args.summer_threshold, args.fall_threshold,
+                       args.winter_threshold]
+    env = Environment(args.height, args.width, args.cycle, food_per_season, args.incremental, seed)
+
+    agents = []
+    for k in range(args.population):
+        # Populations alternate between ants and grasshopers starting with an ant.
+        if k % 2 == 0:
+            agents.append(Ant(args.max_energy, args.energy, env, args.be, args.eat, args.move,
+                              args.forage))
+        else:
+            agents.append(GrassHoper(args.max_energy, args.energy, env, args.be, args.eat,
+                                     args.move, args.sing))
+    return env, agents
+
+def random_policy(agent, rng):
+    """Pick one of the actions available to the agent uniformly at random."""
+    actions = ['skip', 'eat', 'move', 'forage' if isinstance(agent, Ant) else 'sing']
+    action = actions[rng.integers(len(actions))]
+    if action == 'move':
+        deltai, deltaj = rng.integers(-1, 1, size=2, endpoint=True)
+        return action, (int(deltai), int(deltaj))
+    return action, ()
+
+def episode(args, seed):
+    """Play one episode and returns its stats, with its timings and counters under profile."""
+    if args.profile:
+        instrument.enable()
+    env, agents = build(args, seed)
+    # every agent draws its actions from a generator of its own so that deciding them in parallel
+    # threads stays reproducible.
+    policies = [functools.partial(random_policy, rng=env.spawn()) for _ in agents]
+
+    length = 0
+    energy = []
+    with Scheduler(env, agents, policies, args.workers) as scheduler:
+        while length < args.steps and scheduler.step():
+            length = length + 1
+            energy.append(sum(agent.energy for agent in agents) / len(agents))
+
+    stats = {
+        'seed': seed,
+        'length': length,
+        'survivors': sum(1 for agent in agents if agent.energy > 0),
+        'stored': int(env.grid.stored.sum()),
+        'energy': energy,
+    }
+    if args.profile:
+        stats['profile'] = instrument.disable().snapshot()
+    return stats
+
+def run(args):
+    """Yields the stats of every episode as soon as a worker finishes it."""
+    seeds = [args.seed + k for k in range(args.episodes)]
+    with multiprocessing.Pool(args.processes) as pool:
+        for stats in pool.imap_unordered(functools.partial(episode, args), seeds):
+            yield stats
@@ -0,0 +1,74 @@
+""" Turn scheduler playing the agents of an environment in rounds.
+
+Every round each living agent decides its action looking at the same world, then all the actions
+are applied in agent order and the environment ticks once for the whole round. This is the same
+everyone waits for everyone rule the Flask game enforces with Environment.broadcast.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+
+class Scheduler(object):
+    """Collects one action from every living agent and plays them as a single round.
+
+    A policy is called with its agent and returns the name of the agent method to call along with
+    its arguments, for instance ('move', (1, 0)) or ('forage', ()). policies is either one policy
+    shared by every agent or a list holding one policy per agent. With workers set, the policies of
+    a round are called in that many threads.
+    """
+    def __init__(self, env, agents, policies, workers=None):
+        self._env = env
+        self._agents = list(agents)
+        if callable(policies):
+            policies = [policies] * len(self._agents)
+        self._policies = list(policies)
+        self._executor = ThreadPoolExecutor(workers) if workers else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop the threads deciding the actions."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def living(self):
+        """Returns the agents that still have energy left."""
+        return [agent for agent in self._agents if agent.energy > 0]
+
+    def decide(self):
+        """Returns the (agent, action, args) every living agent picked for the round."""
+        players = [(agent, policy) for agent, policy in zip(self._agents, self._policies)
+                   if agent.energy > 0]
+        if self._executor is None:
+            decisions = [policy(agent) for agent, policy in players]
+        else:
+            decisions = self._executor.map(lambda player: player[1](player[0]), players)
+        return [(agent, action, args) for (agent, _), (action, args) in zip(players, decisions)]
+
+    def step(self):
+        """Play one round and returns the agents that took part in it, none once all are dead."""
+        stats = instrument.stats
+        if stats is None:
+            decisions = self.decide()
+            with self._env.round():
+                for agent, action, args in decisions:
+                    getattr(agent, action)(*args)
+            return [agent for agent, _, _ in decisions]
+
+        start = instrument.now()
+        decisions = self.decide()
+        decided = instrument.now()
+        stats.add('round.decide', decided - start)
+        with self._env.round():
+            for agent, action, args in decisions:
+                before = instrument.now()
+                getattr(agent, action)(*args)
+                stats.add('action.' + action, instrument.now() - before)
+        # the closing tick of the round is recorded by simulate itself.
+        stats.add('round', instrument.now() - start)
+        return [agent for agent, _, _ in decisions]
@@ -0,0 +1,201 @@
+""" Batched version of the environment stepping N independent worlds of the same shape in lockstep.
+
+Every world hosts one agent, either an ant or a grasshoper, and all the state lives in stacked
+arrays of shape (N, height, width) for the grids and (N,) for the agents and the calendar. One step
+applies a batch of N actions and simulates the worlds whose action went through with a handful of
+array operations.
+"""
+import numpy as np
+
+from env import Season
+
+# Action codes accepted by VectorEnvironment.step, one per agent method of env.py.
+SKIP = 0
+EAT = 1
+MOVE = 2
+FORAGE = 3
+SING = 4
+
+class VectorEnvironment(object):
+    """N environments and their agents stepped together."""
+    def __init__(self, n, height, width, cycle, food_per_season, ants, max_energy,
+                 initial_energy, be_cost, eat_cost, move_cost, forage_cost, sing_cost, seed=None):
+        self._n = n
+        self._rng = np.random.default_rng(seed)
+        self._height = height
+        self._width = width
+        self._cycle = cycle
+        self._food_per_season = np.asarray(food_per_season, dtype=np.int32)
+
+        self._newly = np.zeros((n, height, width), dtype=np.int32)
+        self._stored = np.zeros((n, height, width), dtype=np.int32)
+        self._energy = self._rng.integers(1, 10, size=(n, height, width), dtype=np.int32,
+                                          endpoint=True)
+        self._seeded = np.zeros((n, height, width), dtype=np.bool_)
+        self._t = np.zeros(n, dtype=np.int32)
+        self._season = np.full(n, Season.SPRING.value, dtype=np.int32)
+
+        # ants[k] tells whether the agent of world k is an ant, otherwise it is a grasshoper.
+        self._ants = np.broadcast_to(np.asarray(ants, dtype=np.bool_), (n,)).copy()
+        self._max_energy = max_energy
+        self._agent_energy = np.full(n, initial_energy, dtype=np.int32)
+        self._i = self._rng.integers(0, height, size=n)
+        self._j = self._rng.integers(0, width, size=n)
+
+        self._be_cost = be_cost
+        self._eat_cost = eat_cost
+        self._move_cost = move_cost
+        self._forage_cost = forage_cost
+        self._sing_cost = sing_cost
+
+        self._worlds = np.arange(n)
+        self._generate_init_env()
+
+    def _generate_init_env(self):
+        """Same filling as Environment._generate_init_env applied to every world at once."""
+        size = self._height * self._width
+        food = self._food_per_season[self._season]
+        production_cap = self._rng.integers(1, size, size=self._n, endpoint=True)
+
+        newly = self._newly.reshape(self._n, size)
+        should_fill = self._rng.integers(0, 1, size=(self._n, size), endpoint=True) == 1
+        should_fill &= newly != food[:, None]
+        # Cells are filled in row order until the production cap of the world is reached.
+        should_fill &= np.cumsum(should_fill, axis=1) <= production_cap[:, None]
+        quantitiy = self._rng.integers(0, food[:, None] - newly, endpoint=True)
+        newly += np.where(should_fill, quantitiy, 0).astype(np.int32)
+
+    @property
+    def n(self):
+        """Get the number of worlds."""
+        return self._n
+
+    @property
+    def height(self):
+        """Get height."""
+        return self._height
+
+    @property
+    def width(self):
+        """Get width."""
+        return self._width
+
+    @property
+    def newly(self):
+        """Get the newly produced food of every world."""
+        return self._newly
+
+    @property
+    def stored(self):
+        """Get the stored food of every world."""
+        return self._stored
+
+    @property
+    def ants(self):
+        """Get whether the agent of every world is an ant."""
+        return self._ants
+
+    @property
+    def energy(self):
+        """Get the energy of every agent."""
+        return self._agent_energy
+
+    @property
+    def positions(self):
+        """Get the (i, j) position of every agent as two arrays."""
+        return self._i, self._j
+
+    def observe(self):
+        """Returns what every agent sees on its cell, the same keys as Ant.show/GrassHoper.show.
+
+        Grasshopers cannot see the newly produced food, their entry in 'newly' is -1.
+        """
+        stored = self._stored[self._worlds, self._i, self._j]
+        newly = self._newly[self._worlds, self._i, self._j]
+        return {'stored': stored, 'newly': np.where(self._ants, newly, -1)}
+
+    def step(self, actions, deltai=None, deltaj=None):
+        """Apply one action per world and simulate the worlds where the action went through.
+
+        actions holds one action code per world, deltai and deltaj give the direction of the MOVE
+        actions and are ignored for the other ones. Actions follow the rules of the env.py agents:
+        an action the agent cannot afford does nothing and does not advance its world.
+        """
+        actions = np.asarray(actions)
+        deltai = np.zeros(self._n, dtype=np.int64) if deltai is None else np.asarray(deltai)
+        deltaj = np.zeros(self._n, dtype=np.int64) if deltaj is None else np.asarray(deltaj)
+
+        worlds, i, j = self._worlds, self._i, self._j
+        energy = self._agent_energy
+        acted = np.zeros(self._n, dtype=np.bool_)
+
+        skip = (actions == SKIP) & (energy >= self._be_cost)
+        energy[skip] -= self._be_cost
+        acted |= skip
+
+        sing = (actions == SING) & ~self._ants & (energy >= self._sing_cost)
+        energy[sing] -= self._sing_cost
+        acted |= sing
+
+        eat = ((actions == EAT) & (energy >= self._eat_cost)
+               & (self._stored[worlds, i, j] > 0))
+        self._stored[worlds[eat], i[eat], j[eat]] -= 1
+        energy[eat] += self._energy[worlds[eat], i[eat], j[eat]] - self._eat_cost
+        acted |= eat
+
+        forage = (actions == FORAGE) & self._ants & (energy >= self._forage_cost)
+        found = forage & (self._newly[worlds, i, j] > 0)
+        self._stored[worlds[found], i[found], j[found]] += 1
+        self._newly[worlds[found], i[found], j[found]] -= 1
+        energy[forage] -= self._forage_cost
+        acted |= forage
+
+        nexti, nextj = i + deltai, j + deltaj
+        move = ((actions == MOVE) & (np.abs(deltai) <= 1) & (np.abs(deltaj) <= 1)
+                & (nexti >= 0) & (nexti < self._height) & (nextj >= 0) & (nextj < self._width)
+                & (energy >= self._move_cost))
+        i[move] = nexti[move]
+        j[move] = nextj[move]
+        energy[move] -= self._move_cost
+        acted |= move
+
+        self.simulate(acted)
+        return self.observe()
+
+    def simulate(self, worlds):
+        """One unit of time simulation of the worlds selected by the boolean mask worlds."""
+        self._t[worlds] += 1
+        rollover = worlds & (self._t == self._cycle)
+        self._t[rollover] = 0
+        self._season[rollover] = (self._season[rollover] + 1) % len(Season)
+        food = self._food_per_season[self._season]
+
+        size = self._height * self._width
+        newly = self._newly.reshape(self._n, size)
+        seeded = self._seeded.reshape(self._n, size)
+        emptied = (newly == 0) & ~seeded & worlds[:, None]
+        owner, flat = np.nonzero(emptied)
+        counts = np.bincount(owner, minlength=self._n)
+        starts = np.cumsum(counts) - counts
+
+        # The k-th emptied cell of every world is handled together. Each world contributes at most
+        # one cell per round, so the seeds of a round never compete for the same world.
+        tries = self._height + self._width
+        for k in range(counts.max() if len(owner) else 0):
+            world = np.flatnonzero(counts > k)
+            cell = flat[starts[world] + k]
+            # an earlier cell of this same tick may already have seeded into this one.
+            live = (newly[world, cell] == 0) & ~seeded[world, cell]
+            world, cell = world[live], cell[live]
+            seeded[world, cell] = True
+
+            candidates = self._rng.integers(0, size, size=(len(world), tries))
+            room = food[world][:, None] - newly[world[:, None], candidates]
+            ok = room > 0
+            placed = ok.any(axis=1)
+            first = ok.argmax(axis=1)[placed]
+            world, candidates, room = world[placed], candidates[placed], room[placed]
+            target = candidates[np.arange(len(world)), first]
+            amount = room[np.arange(len(world)), first]
+            newly[world, target] += self._rng.integers(1, amount, endpoint=True).astype(np.int32)
+            seeded[world, target] = False
@@ -4,3 +4,4 @@ from .generator import User
 from .generator import Environment
 from .generator import Season
 from .generator import Agent
+from .generator import migrate
@@ -0,0 +1,4 @@
+"""Serve the app with python -m generator, on the HOST and PORT of its settings."""
+from .generator import app, socketio
+
+socketio.run(app, host=app.config['HOST'], port=app.config['PORT'])
@@ -1,19 +1,86 @@
 """Creation of the app and matching the blueprints."""
+import atexit
+import logging
 from random import randint
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, session
 from flask_sqlalchemy import SQLAlchemy
-from flask_socketio import SocketIO
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from flask_socketio import SocketIO, join_room
+
+from .profiling import Profiler, handler, install
+from .state import GameStore
 
 app = Flask(__name__)
 app.config.update(dict(
     SQLALCHEMY_DATABASE_URI='sqlite:////tmp/generator.db',
     SQLALCHEMY_TRACK_MODIFICATIONS=True,
-    DEBUG=True,
-    SEND_FILE_MAX_AGE_DEFAULT=0
+    DEBUG=False,
+    SEND_FILE_MAX_AGE_DEFAULT=0,
+    # Every request borrows a connection from the pool instead of opening a new one, and SQLite
+    # databases are switched to write-ahead logging so that readers do not wait on the writer. The
+    # pool is only sized for engines keeping one, SQLALCHEMY_ENGINE_OPTIONS still wins.
+    DATABASE_POOL_SIZE=10,
+    DATABASE_MAX_OVERFLOW=20,
+    SQLITE_WAL=True,
+    # Game state is served from memory and written back every STATE_FLUSH_INTERVAL seconds, and
+    # right after a round ends when STATE_FLUSH_ON_ROUND is set.
+    STATE_FLUSH_INTERVAL=5.0,
+    STATE_FLUSH_ON_ROUND=True,
+    # Url of a message queue such as redis://localhost:6379/0 through which other processes can
+    # emit to the clients of this one. A single server process owns the rooms of a database.
+    SOCKETIO_MESSAGE_QUEUE=None,
+    # Worker model of the server: 'threading', 'eventlet' or 'gevent', None picks the first one
+    # installed in the order eventlet, gevent, threading.
+    SOCKETIO_ASYNC_MODE=None,
+    HOST='127.0.0.1',
+    PORT=5000,
+    LOG_LEVEL='WARNING',
+    # Record the time, SQL statements and commits of every route, event and round, served by
+    # GET /stats.
+    PROFILE=False,
+    # Players per environment, new environments are only created once every one is full.
+    ROOM_CAPACITY=10
 ))
 app.config.from_envvar('GENERATOR_SETTINGS', silent=True)
+
+def engine_options(config):
+    """Returns the engine options, with the pool sized when the engine keeps a QueuePool."""
+    options = config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    # in-memory SQLite keeps a single connection, file SQLite opens one per use before SQLAlchemy 2.
+    poolclass = options.get('poolclass') or url.get_dialect().get_pool_class(url)
+    if not issubclass(poolclass, QueuePool):
+        return options
+    return dict(dict(pool_size=config['DATABASE_POOL_SIZE'],
+                     max_overflow=config['DATABASE_MAX_OVERFLOW']), **options)
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
 db = SQLAlchemy(app)
-socketio = SocketIO(app)
+socketio = SocketIO(app, message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                    async_mode=app.config['SOCKETIO_ASYNC_MODE'])
+# set here rather than by the launcher, so that it holds under any server.
+logging.basicConfig()
+logging.getLogger(__package__).setLevel(app.config['LOG_LEVEL'])
+logger = logging.getLogger(__name__)
+
+def use_wal(connection, record):
+    """Switch every new SQLite connection to write-ahead logging."""
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # commits no longer wait for the disk, a crash can only lose the last transactions.
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+profiler = Profiler() if app.config['PROFILE'] else None
+
+with app.app_context():
+    if app.config['SQLITE_WAL'] and db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', use_wal)
+    if profiler is not None:
+        install(app, db.engine, profiler)
 
 class User(db.Model):
     """User model that encapsulate our user instance and to which agent it is linked."""
@@ -27,6 +94,10 @@ class User(db.Model):
 
 class Cell(db.Model):
     __tablename__ = 'cell'
+    __table_args__ = (
+        # a cell is looked up by its position in the environment, the index also serves envid.
+        db.Index('ix_cell_envid_coordinate', 'envid', 'coordinate', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     coordinate = db.Column(db.Integer, nullable=False)
     newly = db.Column(db.Integer, nullable=False)
@@ -52,6 +123,25 @@ class Season(db.Model):
                      primary_key=True)
     production = db.Column(db.Integer, nullable=False)
 
+    # Seasons never change at runtime, their productions are loaded once per process and kept
+    # here until invalidate is called.
+    _productions = None
+    NEXT = {'spring': 'summer', 'summer': 'fall', 'fall': 'winter', 'winter': 'spring'}
+
+    @staticmethod
+    def productions():
+        """Returns the production of every season by name, populating the table if needed."""
+        if Season._productions is None:
+            Season.populate()
+            Season._productions = {season.name: season.production
+                                   for season in Season.query.all()}
+        return Season._productions
+
+    @staticmethod
+    def invalidate():
+        """Drop the cached productions, the next lookup reloads them from the database."""
+        Season._productions = None
+
     @staticmethod
     def populate():
         spring = Season(name='spring', production=10)
@@ -64,7 +154,11 @@ class Season(db.Model):
             db.session.add(fall)
             db.session.add(winter)
             db.session.add(summer)
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # a concurrent request populated the table first.
+                db.session.rollback()
 
 class Environment(db.Model):
     __tablename__ = 'environment'
@@ -76,33 +170,34 @@ class Environment(db.Model):
     season_desc = db.Column(db.Enum('spring', 'summer', 'fall', 'winter'),
                             db.ForeignKey('season.name'))
     season = db.relationship('Season', backref="envs", lazy=True)
-    cells = db.relationship('Cell', backref='environment', lazy=True)
+    # The whole grid is loaded in a single SELECT in row order when cells is accessed.
+    cells = db.relationship('Cell', backref='environment', lazy=True, order_by='Cell.coordinate')
     agents = db.relationship('Agent', backref='environment', lazy=True)
     nrequest_daily = db.Column(db.Integer, nullable=True)
 
     def __init__(self, height=randint(5, 10), width=0, cycle=20, t=0, **kwargs):
         super(Environment, self).__init__(**kwargs)
         self.height = height
-        print(width)
         if width != 0:
             self.width = width
         else:
             self.width = height
         self.cycle = cycle
         self.t = t
-        self.season = Season.query.filter_by(name='spring').first()
-        if self.season is None:
-            Season.populate()
-        self.season = Season.query.filter_by(name='spring').first()
-        self.season_desc = self.season.name
+        self.season_desc = 'spring'
         self.nrequest_daily = 0
         self.cells = []
         for i in range(0, self.height):
             for j in range(0, self.width):
-                self.cells.append(Cell(i * width + j, 0, 0, randint(5, 10), 0, self.id))
+                self.cells.append(Cell(i * self.width + j, 0, 0, randint(5, 10), 0, self.id))
 
         self.generate_initial()
 
+    @property
+    def production(self):
+        """Get the maximum newly food a cell can hold this season."""
+        return Season.productions()[self.season_desc]
+
     def generate_initial(self):
         production_cap = randint(1, self.height * self.width)
         for i in range(self.height):
@@ -113,82 +208,25 @@ class Environment(db.Model):
                     break
                 cell = self.cells[i * self.width + j]
 
-                if cell.newly >= self.season.production:
+                if cell.newly >= self.production:
                     continue
 
                 should_fill = randint(0, 1)
                 if not should_fill:
                     continue
                 production_cap = production_cap - 1
-                quantity = randint(1, self.season.production - cell.newly)
+                quantity = randint(1, self.production - cell.newly)
 
                 # TODO(khalil): add methods for this type of operations :- cell.produce(quantity).
                 cell.newly += quantity
 
-    def simulate(self):
-        self.t += 1
-        if self.t == self.cycle:
-            # change season to next one
-            self.t = 0
-            if self.season.name == 'spring':
-                self.season = Season.query.filter_by(name='summer').first()
-            elif self.season.name == 'summer':
-                self.season = Season.query.filter_by(name='fall').first()
-            elif self.season.name == 'fall':
-                self.season = Season.query.filter_by(name='winter').first()
-            elif self.season.name == 'winter':
-                self.season = Season.query.filter_by(name='spring').first()
-            self.season_desc = self.season.name
-
-        for i in range(self.height):
-            for j in range(self.width):
-                cell = self.cells[i * self.width + j]
-                if cell.newly == 0 and not cell.seeded:
-                    # if the cell become empty just now seed in once in a randomn cell on the grid.
-                    cell.seeded = True
-                    cap = self.height + self.width
-                    while cap > 0:
-                        seedi = randint(0, self.height - 1)
-                        seedj = randint(0, self.width - 1)
-
-                        production_cap = self.season.production
-
-                        rcell = self.cells[seedi * self.width + seedj]
-                        production_cap -= rcell.newly
-
-                        if production_cap > 0:
-                            seed_amount = randint(1, production_cap)
-                            rcell.newly += seed_amount
-                            rcell.seeded = False
-                            db.session.commit()
-                            break
-
-                        cap = cap - 1
-        db.session.commit()
-
-    def broadcast(self):
-        self.nrequest_daily += 1
-        print(len(Agent.query.filter_by(envid=self.id).all()))
-
-        log = {
-            'id': self.id,
-            'remaining': len(Agent.query.filter_by(envid=self.id).all()) - self.nrequest_daily
-        }
-        if self.nrequest_daily >= len(Agent.query.filter_by(envid=self.id).all()):
-            agents = Agent.query.filter_by(envid=self.id).all()
-            dead = []
-            for agent in agents:
-                if agent.energy == 0:
-                    dead.append(agent.id)
-            log['dead'] = dead
-
-            self.nrequest_daily = 0
-            self.simulate()
-        socketio.emit('refresh', log)
-
 
 class Agent(db.Model):
     __tablename__ = 'agent'
+    __table_args__ = (
+        # agents are filtered by environment and counted by type per environment.
+        db.Index('ix_agent_envid_type', 'envid', 'type'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String(50))
     max_energy = db.Column(db.Integer, nullable=False)
@@ -204,75 +242,9 @@ class Agent(db.Model):
     has_played = db.Column(db.Boolean)
 
 
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     envid = db.Column(db.Integer, db.ForeignKey('environment.id'), nullable=False)
 
-    def show(self, cell):
-        """Returns what the agent can see and depends on what type of agent."""
-        raise NotImplementedError
-
-    def eat(self):
-        """Consume one unit of stored food to increase energy level."""
-        if self.has_played:
-            return False
-        if self.energy < self.eat_cost:
-            return
-
-        environment = Environment.query.filter_by(id=self.envid).first()
-        cell = environment.cells[self.i * environment.width + self.j]
-
-        if cell.stored == 0:
-            return
-        cell.stored -= 1
-        self.energy = self.energy + cell.energy
-
-        self.energy = self.energy - self.eat_cost
-
-        environment.broadcast()
-        self.has_played = True
-
-        db.session.commit()
-
-    def move(self, deltai, deltaj):
-        """Agent moves in one of the eight 2-d directions with sanity checking of new postition."""
-        if self.has_played:
-            return False
-        if abs(deltai) > 1 or abs(deltaj) > 1:
-            return False
-        environment = Environment.query.filter_by(id=self.envid).first()
-
-        if self.i + deltai >= environment.height or self.j + deltaj >= environment.width:
-            return False
-        if self.i + deltai < 0 or self.j + deltaj < 0:
-            return False
-
-        if self.energy < self.move_cost:
-            return False
-
-        self.i = self.i + deltai
-        self.j = self.j + deltaj
-
-        self.energy = self.energy - self.move_cost
-
-        environment.broadcast()
-        self.has_played = True
-
-        db.session.commit()
-        return True
-
-    def be(self):
-        if self.has_played:
-            return False
-        environment = Environment.query.filter_by(id=self.envid).first()
-
-        self.energy = max(self.energy - self.be_cost, 0)
-
-        environment.broadcast()
-        self.has_played = True
-
-        db.session.commit()
-        return True
-
     __mapper_args__ = {
         'polymorphic_on': type,
         'polymorphic_identity': 'agent'
@@ -281,37 +253,6 @@ class Agent(db.Model):
 class Ant(Agent):
     forage_cost = db.Column(db.Integer)
 
-    def show(self, cell):
-        return {
-            'newly': cell.newly,
-            'stored': cell.stored
-        }
-
-    def forage(self):
-        """Forage takes a cell and adds stored by reducing a newly."""
-        if self.has_played:
-            return False
-        if self.energy < self.forage_cost:
-            return False
-
-        environment = Environment.query.filter_by(id=self.envid).first()
-        cell = environment.cells[self.i * environment.width + self.j]
-        if cell.newly > 0:
-            cell.stored += 1
-            cell.newly -= 1
-        else:
-            return False
-
-        self.energy = self.energy - self.forage_cost
-
-        environment.broadcast()
-        self.has_played = True
-
-        db.session.commit()
-
-        return True
-
-
     __mapper_args__ = {
         'polymorphic_identity':'ant'
     }
@@ -319,11 +260,6 @@ class Ant(Agent):
 class Grasshopper(Agent):
     sing_cost = db.Column(db.Integer)
 
-    def show(self, cell):
-        return {
-            'stored': cell.stored
-        }
-
     __mapper_args__ = {
         'polymorphic_identity':'grasshopper'
     }
@@ -341,38 +277,22 @@ def dashboard(username):
         db.session.add(user)
         db.session.commit()
 
-    environment = None
     agent = user.agent
     if user.agent is None:
-        environments = Environment.query.all()
+        # the least crowded environment with room left, a new one when they are all full.
+        envid, kind = store.assign(create_environment)
+        environment = store.room(envid)
 
-        options = len(environments)
-
-        target = randint(0, options)
-        if target == 0:
-            # create a new environment and host this agent in it.
-            environment = Environment()
-            db.session.add(environment)
-            db.session.commit()
-        else:
-            environment = environments[target - 1]
-
-        agents = len(Agent.query.filter_by(envid=environment.id).all())
-        hoppers = len(Agent.query.filter_by(envid=environment.id, type='grasshopper').all())
-        ants = len(Agent.query.filter_by(envid=environment.id, type='ant').all())
-
-        assert agents == hoppers + ants
-
-        if hoppers < ants:
+        if kind == 'grasshopper':
             # create a grasshoper for the current player otherwise create an ant.
             agent = Grasshopper(sing_cost=2, max_energy=100, energy=90, be_cost=1, eat_cost=1,
-                                move_cost=2, envid=environment.id, user_id=user.id,
+                                move_cost=2, envid=envid, user_id=user.id,
                                 has_played=False,
                                 i=randint(0, environment.height - 1),
                                 j=randint(0, environment.width - 1))
         else:
             agent = Ant(forage_cost=2, max_energy=100, energy=90, be_cost=1, eat_cost=1,
-                        move_cost=2, envid=environment.id, user_id=user.id,
+                        move_cost=2, envid=envid, user_id=user.id,
                         has_played=False,
                         i=randint(0, environment.height - 1),
                         j=randint(0, environment.width - 1))
@@ -381,86 +301,160 @@ def dashboard(username):
 
         db.session.add(agent)
         db.session.commit()
-    else:
-        environment = Environment.query.filter_by(id=agent.envid).first()
 
-    cell = environment.cells[agent.i * environment.width + agent.j]
-    percepts = agent.show(cell)
+    room, agent = store.join(username, agent)
     return render_template('dashboard.html',
                            user=user,
                            agent=agent,
-                           environment=environment,
-                           percepts=percepts,
+                           environment=room,
+                           percepts=room.percepts(agent),
                            grid=True
                           )
 
+def create_environment():
+    """Create a new environment for players to join, returns its id."""
+    environment = Environment()
+    db.session.add(environment)
+    db.session.commit()
+    return environment.id
+
+def announce(room, log):
+    """Tell the clients about an action that went through.
+
+    While players are missing the room gets the usual refresh message, once the round ends it gets
+    the delta of the round and every connected player its own percepts.
+    """
+    if log is None:
+        return
+    delta = log.pop('delta', None)
+    if delta is None:
+        socketio.emit('refresh', log, to=environment_room(room.id))
+        return
+
+    delta.update(log)
+    socketio.emit('delta', delta, to=environment_room(room.id))
+    for agent in list(room.agents.values()):
+        socketio.emit('percepts', percepts_message(room, agent), to=agent_room(agent.id))
+    if app.config['STATE_FLUSH_ON_ROUND']:
+        store.request_flush()
+
+def environment_room(envid):
+    """Name of the Socket.IO room of the pages playing in environment envid."""
+    return 'environment/%d' % envid
+
+def agent_room(agent_id):
+    """Name of the Socket.IO room of the page playing agent_id, it gets the percepts."""
+    return 'agent/%d' % agent_id
+
+def percepts_message(room, agent):
+    """Returns what the agent sees of itself and its cell."""
+    return {
+        'id': agent.id,
+        'i': agent.i,
+        'j': agent.j,
+        'energy': agent.energy,
+        'percepts': room.percepts(agent)
+    }
+
+@socketio.on('join')
+@handler(profiler, 'event.join')
+def join(message):
+    """A player page connected, it joins the rooms of its environment and of its agent.
+
+    It gets the whole room once, the deltas of the next rounds only carry what changed.
+    """
+    room, agent = store.player(message['username'])
+    if agent is not None:
+        # the actions sent over this socket are played by this agent.
+        session['username'] = message['username']
+        join_room(environment_room(room.id))
+        join_room(agent_room(agent.id))
+        socketio.emit('snapshot', room.snapshot(), to=request.sid)
+        socketio.emit('percepts', percepts_message(room, agent), to=request.sid)
+
+@socketio.on('action')
+@handler(profiler, 'event.action')
+def action(message):
+    """An action sent over the socket of a player page, acknowledged with whether it was played.
+
+    The message is {'action': 'move', 'deltai': -1, 'deltaj': 0} or {'action': 'eat'|'forage'|'be'}
+    and the action is played by the agent of the page that joined on this socket.
+    """
+    room, agent = store.player(session.get('username'))
+    if agent is None or not isinstance(message, dict):
+        return False
+
+    name = message.get('action')
+    if name == 'move':
+        try:
+            deltai = int(message['deltai'])
+            deltaj = int(message['deltaj'])
+        except (KeyError, TypeError, ValueError):
+            return False
+        log = room.move(agent, deltai, deltaj)
+    elif name in ('eat', 'forage', 'be'):
+        log = getattr(room, name)(agent)
+    else:
+        return False
+    announce(room, log)
+    return log is not None
+
 @app.route('/<username>/move', methods=['POST'])
 def move(username):
     if request.method == 'POST':
-        print('move has been sent and should be processed')
+        logger.debug('%s moves', username)
         deltai = int(request.form['deltai'])
         deltaj = int(request.form['deltaj'])
 
-        user = User.query.filter_by(username=username).first()
-        agent = user.agent
-        agent.move(deltai, deltaj)
-        db.session.commit()
+        room, agent = store.player(username)
+        announce(room, room.move(agent, deltai, deltaj))
     return ('', 204)
 
 @app.route('/<username>/forage', methods=['POST'])
 def forage(username):
     if request.method == 'POST':
-        print('forage request emmited by an ant I hope.')
+        logger.debug('%s forages', username)
 
-        user = User.query.filter_by(username=username).first()
-        agent = user.agent
+        room, agent = store.player(username)
         if agent.type != 'ant':
             return 'Grasshopper cannot forage.'
-        agent.forage()
-        db.session.commit()
+        announce(room, room.forage(agent))
     return ('', 204)
 
 @app.route('/<username>/eat', methods=['POST'])
 def eat(username):
     if request.method == 'POST':
-        print('eat request emmited by an ant I hope.')
+        logger.debug('%s eats', username)
 
-        user = User.query.filter_by(username=username).first()
-        agent = user.agent
-        agent.eat()
-        db.session.commit()
+        room, agent = store.player(username)
+        announce(room, room.eat(agent))
     return ('', 204)
 
 @app.route('/<username>/be', methods=['POST'])
 def be(username):
     if request.method == 'POST':
-        print('be request emmited by an ant I hope.')
+        logger.debug('%s does nothing', username)
 
-        user = User.query.filter_by(username=username).first()
-        agent = user.agent
-        agent.be()
-        db.session.commit()
+        room, agent = store.player(username)
+        announce(room, room.be(agent))
     return ('', 204)
 
 @app.route('/<username>/refresh', methods=['GET'])
 def refresh(username):
-    user = User.query.filter_by(username=username).first()
-    agent = user.agent
-    agent.has_played = False
-    environment = Environment.query.filter_by(id=agent.envid).first()
-    cell = environment.cells[agent.i * environment.width + agent.j]
-    percepts = agent.show(cell)
-
-    db.session.commit()
+    room, agent = store.player(username)
     return render_template('environment.html',
-                           user=user,
+                           user={'username': username},
                            agent=agent,
-                           environment=environment,
-                           percepts=percepts)
+                           environment=room,
+                           percepts=room.percepts(agent))
 
 
 @app.route('/<username>/erase')
 def erase(username):
+    room, log = store.leave(username)
+    if room is not None:
+        # the others may all have played already, the round then ends without this player.
+        announce(room, log)
     user = User.query.filter_by(username=username).first()
     agent = user.agent
     db.session.delete(user)
@@ -468,5 +462,31 @@ def erase(username):
     db.session.commit()
     return render_template('over.html')
 
-if __name__ == '__main__':
-    socketio.run(app)
+def migrate():
+    """Bring a database created by an older version up to date.
+
+    Cells used to be numbered with the width argument of Environment, which is 0 by default, so
+    their coordinates are recomputed from their insertion order before the indexes are created.
+    Running it on an up to date database changes nothing.
+    """
+    db.create_all()
+    db.session.execute(db.text(
+        'UPDATE cell SET coordinate = (SELECT COUNT(*) FROM cell AS other '
+        'WHERE other.envid = cell.envid AND other.id < cell.id)'))
+    db.session.commit()
+    for table in (Cell.__table__, Agent.__table__, User.__table__):
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Add the indexes and fix the cell coordinates of an existing database."""
+    migrate()
+
+store = GameStore(app, db, Environment, Cell, Agent, User, Season, profiler,
+                  app.config['ROOM_CAPACITY'])
+
+@atexit.register
+def close_store():
+    """Flush what is left in memory when the process exits."""
+    store.close()
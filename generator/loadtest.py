@@ -0,0 +1,143 @@
+""" Load test of a running server, many simulated players play rounds over Socket.IO at once.
+
+Every player creates its agent through the dashboard route like a browser would, joins its room on
+its own socket and plays one random action as soon as the previous round ended. The summary tells
+how many rounds the server got through per second and how long it took to acknowledge actions, run
+it against servers of different settings to compare them. It needs the socketio client
+(pip install "python-socketio[client]").
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+import socketio
+
+ACTIONS = ['be', 'eat', 'forage', 'move']
+MOVES = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+class Stats(object):
+    """Counters shared by the players."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.refused = 0
+        # environment id -> rounds seen ended in it.
+        self.rounds = {}
+        self.finished = 0
+
+    def acked(self, latency, played):
+        with self.lock:
+            self.latencies.append(latency)
+            if not played:
+                self.refused += 1
+
+    def round(self, envid, seen):
+        with self.lock:
+            self.rounds[envid] = max(self.rounds.get(envid, 0), seen)
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def play(url, username, rounds, stats, timeout, start):
+    """One player: create its agent, then play until rounds rounds ended or it died."""
+    http = requests.Session()
+    client = socketio.Client()
+    done = threading.Event()
+    seen = [0]
+    # id of the agent of this player, the server sends its percepts as soon as it joined.
+    me = [None]
+
+    def act(action=None):
+        action = action or random.choice(ACTIONS)
+        message = {'action': action}
+        if action == 'move':
+            message['deltai'], message['deltaj'] = random.choice(MOVES)
+        sent = time.perf_counter()
+
+        def ack(played):
+            stats.acked(time.perf_counter() - sent, played)
+            if not played and action != 'be':
+                # doing nothing is always allowed, so the round cannot stall on this player.
+                act('be')
+        client.emit('action', message, callback=ack)
+
+    @client.on('percepts')
+    def percepts(message):
+        me[0] = message['id']
+
+    @client.on('delta')
+    def delta(message):
+        seen[0] += 1
+        stats.round(message['id'], seen[0])
+        if seen[0] >= rounds or me[0] in message['dead']:
+            done.set()
+        else:
+            act()
+
+    try:
+        http.get('%s/%s/create' % (url, username)).raise_for_status()
+        client.connect(url, transports=['websocket'])
+        client.call('join', {'username': username}, timeout=timeout)
+    except Exception:
+        # the other players would wait for this one forever.
+        start.abort()
+        raise
+    # rooms only play full rounds once every player of the run is in.
+    start.wait()
+    act()
+    finished = done.wait(timeout * rounds)
+    client.disconnect()
+    http.get('%s/%s/erase' % (url, username))
+    if finished:
+        with stats.lock:
+            stats.finished += 1
+
+def run(args):
+    """Start every player at once and returns the summary once they are all done."""
+    stats = Stats()
+    prefix = args.prefix or 'load%d' % os.getpid()
+    start = threading.Barrier(args.players + 1)
+    players = [threading.Thread(target=play, args=(args.url, '%s-%d' % (prefix, k), args.rounds,
+                                                   stats, args.timeout, start))
+               for k in range(args.players)]
+    for player in players:
+        player.start()
+    start.wait()
+    begin = time.perf_counter()
+    for player in players:
+        player.join()
+    elapsed = time.perf_counter() - begin
+
+    actions = len(stats.latencies)
+    return {
+        'players': args.players,
+        'finished': stats.finished,
+        'rooms': len(stats.rounds),
+        'seconds': round(elapsed, 3),
+        'actions': actions,
+        'refused': stats.refused,
+        'actions_per_second': round(actions / elapsed, 1),
+        'rounds_per_second': round(sum(stats.rounds.values()) / elapsed, 1),
+        'ack_p50_ms': round(1000 * _percentile(stats.latencies, 0.5), 2) if actions else None,
+        'ack_p99_ms': round(1000 * _percentile(stats.latencies, 0.99), 2) if actions else None
+    }
+
+def parse(argv=None):
+    parser = argparse.ArgumentParser(description='Load test a running generator server.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='server to load')
+    parser.add_argument('--players', '-p', type=int, default=20, help='simulated players')
+    parser.add_argument('--rounds', '-r', type=int, default=30, help='rounds every player plays')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds to wait for a round before giving up on it')
+    parser.add_argument('--prefix', help='prefix of the usernames, defaults to load<pid>')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    print(json.dumps(run(parse())))
@@ -0,0 +1,125 @@
+"""Opt-in timings and counters of the app, served as JSON by /stats when PROFILE is set.
+
+Every route and Socket.IO event records how long it took along with the number of SQL statements
+and commits it ran. Rooms and the writer record their own phases. Nothing is installed when
+PROFILE is off, the rooms then only check that their profiler is None.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+from flask import g, has_app_context, jsonify, request
+from sqlalchemy import event
+
+class Profiler(object):
+    """Time spent in every named phase, along with the counters recorded during it."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'max': 0.0,
+                                            'queries': 0, 'commits': 0})
+
+    def record(self, name, seconds, queries=0, commits=0):
+        """Record one run of phase name."""
+        with self._lock:
+            phase = self._phases[name]
+            phase['count'] += 1
+            phase['seconds'] += seconds
+            phase['max'] = max(phase['max'], seconds)
+            phase['queries'] += queries
+            phase['commits'] += commits
+
+    @contextmanager
+    def timer(self, name):
+        """Record the time spent in the with block as one run of phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def begin(self):
+        """Start counting the statements and commits of the current request or event."""
+        g.profile = {'start': time.perf_counter(), 'queries': 0, 'commits': 0}
+
+    def end(self, name):
+        """Record the current request or event as one run of phase name."""
+        profile = g.pop('profile', None)
+        if profile is not None:
+            self.record(name, time.perf_counter() - profile['start'], profile['queries'],
+                        profile['commits'])
+
+    def count(self, key):
+        """Count one statement or commit, key is queries or commits."""
+        if has_app_context() and 'profile' in g:
+            g.profile[key] += 1
+        else:
+            # statements run outside of a request, the writer mostly.
+            self.record('background.' + key, 0.0, **{key: 1})
+
+    def snapshot(self):
+        """Returns everything recorded so far, times in milliseconds and counts per run."""
+        with self._lock:
+            phases = {name: dict(phase) for name, phase in self._phases.items()}
+        return {
+            name: {
+                'count': phase['count'],
+                'total_ms': 1000 * phase['seconds'],
+                'mean_ms': 1000 * phase['seconds'] / phase['count'],
+                'max_ms': 1000 * phase['max'],
+                'queries_per_run': phase['queries'] / phase['count'],
+                'commits_per_run': phase['commits'] / phase['count']
+            }
+            for name, phase in phases.items()
+        }
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._phases.clear()
+
+def handler(profiler, name):
+    """Decorator recording every call of a Socket.IO event handler as phase name.
+
+    Its statements and commits are counted too, the function is left as is without profiler.
+    """
+    def decorator(function):
+        if profiler is None:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler.begin()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.end(name)
+        return wrapper
+    return decorator
+
+def install(app, engine, profiler):
+    """Hook profiler into the requests of app and the statements of engine, adds GET /stats."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(*args):
+        profiler.count('queries')
+
+    @event.listens_for(engine, 'commit')
+    def count_commit(*args):
+        profiler.count('commits')
+
+    @app.before_request
+    def begin_request():
+        profiler.begin()
+
+    @app.teardown_request
+    def end_request(exception=None):
+        profiler.end('route.' + str(request.endpoint))
+
+    @app.route('/stats')
+    def stats():
+        """Everything recorded so far, ?reset=1 starts over once it is returned."""
+        snapshot = profiler.snapshot()
+        if request.args.get('reset'):
+            profiler.reset()
+        return jsonify(snapshot)
@@ -0,0 +1,540 @@
+"""In-memory authoritative game state with write-behind persistence.
+
+Rooms hold the grid and the agents of one environment in compact structures and every action is
+served from memory. A background writer flushes the rooms that changed to the database every
+STATE_FLUSH_INTERVAL seconds, and as soon as possible once a round ends when STATE_FLUSH_ON_ROUND
+is set.
+"""
+from array import array
+from collections import Counter
+import heapq
+import logging
+from random import randint
+import threading
+
+logger = logging.getLogger(__name__)
+
+class AgentState(object):
+    """Compact in-memory copy of an agent row."""
+    __slots__ = ('id', 'type', 'user_id', 'max_energy', 'energy', 'be_cost', 'eat_cost',
+                 'move_cost', 'forage_cost', 'sing_cost', 'i', 'j', 'has_played')
+
+    def __init__(self, agent):
+        for name in self.__slots__:
+            # ants have no sing_cost and grasshoppers no forage_cost.
+            setattr(self, name, getattr(agent, name, None))
+
+class Room(object):
+    """Grid and agents of one environment, every mutation is recorded for the writer.
+
+    cells are the rows of the grid in coordinate order, anything with the id, newly, stored, energy
+    and seeded of a cell.
+    """
+    def __init__(self, environment, cells, productions, next_season, profiler=None):
+        self.id = environment.id
+        self.height = environment.height
+        self.width = environment.width
+        self.cycle = environment.cycle
+        self.t = environment.t
+        self.season_desc = environment.season_desc
+        self.nrequest_daily = environment.nrequest_daily or 0
+        self.productions = productions
+        self.next_season = next_season
+
+        self.cell_ids = array('i', [cell.id for cell in cells])
+        self.newly = array('i', [cell.newly for cell in cells])
+        self.stored = array('i', [cell.stored for cell in cells])
+        self.energy = array('i', [cell.energy for cell in cells])
+        self.seeded = bytearray(bool(cell.seeded) for cell in cells)
+        self.agents = {agent.id: AgentState(agent) for agent in environment.agents}
+        self.dead = {agent.id for agent in self.agents.values() if agent.energy == 0}
+        # coordinate -> ids of the agents on that cell.
+        self.occupants = {}
+        for agent in self.agents.values():
+            self._occupy(agent)
+
+        self.profiler = profiler
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.dirty_cells = set()
+        self.dirty_agents = set()
+        # What changed during the current round, sent to the clients as a delta when it ends.
+        self.round_cells = set()
+        self.round_agents = set()
+        self.round_left = set()
+
+    @property
+    def production(self):
+        """Get the maximum newly food a cell can hold this season."""
+        return self.productions[self.season_desc]
+
+    def add(self, agent):
+        """Host an agent row that was created after the room got loaded."""
+        with self.lock:
+            if agent.id not in self.agents:
+                self.agents[agent.id] = AgentState(agent)
+                self._occupy(self.agents[agent.id])
+                self.round_agents.add(agent.id)
+                if agent.energy == 0:
+                    self.dead.add(agent.id)
+            return self.agents[agent.id]
+
+    def remove(self, agent_id):
+        """Forget an agent that left the game.
+
+        Returns its state and the log to emit, the round ends when every agent left played it
+        already. Both are None if the agent was not here.
+        """
+        with self.lock:
+            agent = self.agents.pop(agent_id, None)
+            self.dead.discard(agent_id)
+            self.dirty_agents.discard(agent_id)
+            self.round_agents.discard(agent_id)
+            if agent is None:
+                return None, None
+            self._vacate(agent)
+            self.round_left.add(agent_id)
+            if agent.has_played and self.nrequest_daily > 0:
+                # its action no longer counts toward the end of the round.
+                self.nrequest_daily -= 1
+            if not self.agents:
+                self.nrequest_daily = 0
+            self.dirty = True
+            log = {
+                'id': self.id,
+                'remaining': len(self.agents) - self.nrequest_daily
+            }
+            if self.agents and self.nrequest_daily >= len(self.agents):
+                self._end_round(log)
+            return agent, log
+
+    def _occupy(self, agent):
+        self.occupants.setdefault(agent.i * self.width + agent.j, set()).add(agent.id)
+
+    def _vacate(self, agent):
+        k = agent.i * self.width + agent.j
+        self.occupants[k].discard(agent.id)
+        if not self.occupants[k]:
+            del self.occupants[k]
+
+    def at(self, i, j):
+        """Returns the agents on the cell (i, j)."""
+        return [self.agents[agent_id] for agent_id in self.occupants.get(i * self.width + j, ())]
+
+    def snapshot(self):
+        """Returns what every type of agent can see of the whole room, the deltas then patch it."""
+        with self.lock:
+            return {
+                'id': self.id,
+                'height': self.height,
+                'width': self.width,
+                't': self.t,
+                'season': self.season_desc,
+                'stored': self.stored.tolist(),
+                'agents': [[agent.id, agent.type, agent.i, agent.j, agent.energy]
+                           for agent in self.agents.values()]
+            }
+
+    def percepts(self, agent):
+        """Returns what the agent sees on its cell, only ants see the newly food."""
+        k = agent.i * self.width + agent.j
+        if agent.type == 'ant':
+            return {'newly': self.newly[k], 'stored': self.stored[k]}
+        return {'stored': self.stored[k]}
+
+    def _changed_cell(self, k):
+        # the stored food of cell k changed, seeding only touches what the delta leaves out.
+        self.dirty_cells.add(k)
+        self.round_cells.add(k)
+
+    def _played(self, agent):
+        agent.has_played = True
+        self.dirty_agents.add(agent.id)
+        self.round_agents.add(agent.id)
+        if agent.energy == 0:
+            self.dead.add(agent.id)
+        else:
+            self.dead.discard(agent.id)
+        return self.broadcast()
+
+    def move(self, agent, deltai, deltaj):
+        """Move the agent, returns the broadcast log or None when the move was refused."""
+        with self.lock:
+            if agent.has_played:
+                return None
+            if abs(deltai) > 1 or abs(deltaj) > 1:
+                return None
+            if not 0 <= agent.i + deltai < self.height or not 0 <= agent.j + deltaj < self.width:
+                return None
+            if agent.energy < agent.move_cost:
+                return None
+
+            self._vacate(agent)
+            agent.i = agent.i + deltai
+            agent.j = agent.j + deltaj
+            self._occupy(agent)
+            agent.energy = agent.energy - agent.move_cost
+            return self._played(agent)
+
+    def eat(self, agent):
+        """Consume one unit of stored food, returns the broadcast log or None."""
+        with self.lock:
+            if agent.has_played or agent.energy < agent.eat_cost:
+                return None
+            k = agent.i * self.width + agent.j
+            if self.stored[k] == 0:
+                return None
+            self.stored[k] -= 1
+            self._changed_cell(k)
+            agent.energy = agent.energy + self.energy[k] - agent.eat_cost
+            return self._played(agent)
+
+    def be(self, agent):
+        """Skip the day, returns the broadcast log or None."""
+        with self.lock:
+            if agent.has_played:
+                return None
+            agent.energy = max(agent.energy - agent.be_cost, 0)
+            return self._played(agent)
+
+    def forage(self, agent):
+        """Store one unit of newly food for an ant, returns the broadcast log or None."""
+        with self.lock:
+            if agent.has_played or agent.type != 'ant' or agent.energy < agent.forage_cost:
+                return None
+            k = agent.i * self.width + agent.j
+            if self.newly[k] == 0:
+                return None
+            self.stored[k] += 1
+            self.newly[k] -= 1
+            self._changed_cell(k)
+            agent.energy = agent.energy - agent.forage_cost
+            return self._played(agent)
+
+    def broadcast(self):
+        """Count the action and end the round once every agent played, returns the log to emit."""
+        self.nrequest_daily += 1
+        self.dirty = True
+        log = {
+            'id': self.id,
+            'remaining': len(self.agents) - self.nrequest_daily
+        }
+        if self.nrequest_daily >= len(self.agents):
+            self._end_round(log)
+        return log
+
+    def _end_round(self, log):
+        # every agent played, simulate the day and add what the clients need to log.
+        log['dead'] = list(self.dead)
+        self.nrequest_daily = 0
+        if self.profiler is None:
+            self.simulate()
+        else:
+            with self.profiler.timer('room.simulate'):
+                self.simulate()
+        # every agent saw the round end and can play the next one.
+        for agent in self.agents.values():
+            agent.has_played = False
+        self.dirty_agents.update(self.agents)
+        log['delta'] = self.delta()
+
+    def delta(self):
+        """Returns what changed since the last delta and starts a new one.
+
+        Only what every type of agent can see is part of it: the stored food of the changed cells
+        as [coordinate, stored], the changed agents as [id, type, i, j, energy] and the ids of the
+        agents that left. The newly food only reaches the ants through their own percepts.
+        """
+        cells = [[k, self.stored[k]] for k in sorted(self.round_cells)]
+        agents = [[agent.id, agent.type, agent.i, agent.j, agent.energy]
+                  for agent in map(self.agents.get, sorted(self.round_agents))
+                  if agent is not None]
+        left = sorted(self.round_left)
+        self.round_cells = set()
+        self.round_agents = set()
+        self.round_left = set()
+        return {'t': self.t, 'season': self.season_desc, 'cells': cells, 'agents': agents,
+                'left': left}
+
+    def simulate(self):
+        """One unit of time simulation."""
+        self.t += 1
+        if self.t == self.cycle:
+            self.t = 0
+            self.season_desc = self.next_season[self.season_desc]
+
+        production = self.production
+        free = [k for k, newly in enumerate(self.newly) if newly < production]
+        for k, newly in enumerate(self.newly):
+            if newly == 0 and not self.seeded[k]:
+                self.seeded[k] = True
+                self.dirty_cells.add(k)
+                if not free:
+                    continue
+                slot = randint(0, len(free) - 1)
+                seed = free[slot]
+                self.newly[seed] += randint(1, production - self.newly[seed])
+                self.seeded[seed] = False
+                self.dirty_cells.add(seed)
+                if self.newly[seed] >= production:
+                    free[slot] = free[-1]
+                    free.pop()
+
+    def collect(self):
+        """Returns the rows that changed since the last call as bulk update mappings."""
+        with self.lock:
+            environment = []
+            if self.dirty:
+                environment.append({'id': self.id, 't': self.t, 'season_desc': self.season_desc,
+                                    'nrequest_daily': self.nrequest_daily})
+            cells = [{'id': self.cell_ids[k], 'newly': self.newly[k], 'stored': self.stored[k],
+                      'seeded': bool(self.seeded[k])} for k in self.dirty_cells]
+            agents = [{'id': agent.id, 'energy': agent.energy, 'i': agent.i, 'j': agent.j,
+                       'has_played': agent.has_played}
+                      for agent in map(self.agents.get, self.dirty_agents) if agent is not None]
+            self.dirty = False
+            self.dirty_cells = set()
+            self.dirty_agents = set()
+        return environment, cells, agents
+
+    def restore(self, environment, cells, agents):
+        """Mark the rows collect returned as changed again after they failed to be written."""
+        with self.lock:
+            if environment:
+                self.dirty = True
+            if cells:
+                coordinates = {cell_id: k for k, cell_id in enumerate(self.cell_ids)}
+                self.dirty_cells.update(coordinates[cell['id']] for cell in cells)
+            # the next collect writes their current values, agents that left are not written.
+            self.dirty_agents.update(agent['id'] for agent in agents if agent['id'] in self.agents)
+
+class Matchmaker(object):
+    """Open environments ordered by number of players, new players go to the least crowded one.
+
+    A heap holds (players, environment id) for every environment under capacity. Entries are not
+    updated in place: a change pushes a new entry and the outdated ones are skipped when they come
+    up, so assigning a player is O(log n) in the number of environments.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # environment id -> Counter of its agents by type.
+        self._counts = {}
+        self._heap = []
+
+    def _push(self, envid):
+        players = sum(self._counts[envid].values())
+        if players < self.capacity:
+            heapq.heappush(self._heap, (players, envid))
+
+    def open(self, envid, counts=None):
+        """Start tracking an environment with counts agents of every type, none by default."""
+        with self._lock:
+            self._counts[envid] = Counter(counts or {})
+            self._push(envid)
+
+    def assign(self, create):
+        """Returns the environment id and the agent type of the next player and counts them in.
+
+        create is called to make a new environment and returns its id when every environment is
+        full.
+        """
+        with self._lock:
+            while self._heap:
+                players, envid = self._heap[0]
+                counts = self._counts.get(envid)
+                if counts is None or players != sum(counts.values()):
+                    heapq.heappop(self._heap)
+                    continue
+                break
+            else:
+                envid = create()
+                self._counts[envid] = Counter()
+
+            counts = self._counts[envid]
+            # the same balance of types as before, a grasshopper only when ants outnumber them.
+            kind = 'grasshopper' if counts['grasshopper'] < counts['ant'] else 'ant'
+            counts[kind] += 1
+            self._push(envid)
+            return envid, kind
+
+    def leave(self, envid, kind):
+        """A player of type kind left environment envid, its place is open again."""
+        with self._lock:
+            counts = self._counts.get(envid)
+            if counts is not None and counts[kind] > 0:
+                counts[kind] -= 1
+                self._push(envid)
+
+class GameStore(object):
+    """Rooms of this process keyed by environment id, with the writer flushing them.
+
+    The process owns every environment of the database, players are only counted and rooms only
+    loaded here.
+    """
+    def __init__(self, app, db, environment_model, cell_model, agent_model, user_model,
+                 season_model, profiler=None, capacity=10):
+        self._app = app
+        self._db = db
+        self._environment_model = environment_model
+        self._cell_model = cell_model
+        self._agent_model = agent_model
+        self._user_model = user_model
+        self._season_model = season_model
+        self._profiler = profiler
+        self._capacity = capacity
+        self._matchmaker = None
+
+        self._lock = threading.Lock()
+        self._rooms = {}
+        # username -> (environment id, agent id) of every player seen by this process.
+        self._players = {}
+        self._wake = threading.Event()
+        self._writer = None
+        self._closed = False
+
+    def room(self, envid):
+        """Returns the room of environment envid, loading it from the database on first use."""
+        with self._lock:
+            room = self._rooms.get(envid)
+            if room is None:
+                environment = self._environment_model.query.filter_by(id=envid).first()
+                cell = self._cell_model
+                # plain rows read in index order through (envid, coordinate), no Cell is built.
+                cells = self._db.session.query(
+                    cell.id, cell.newly, cell.stored, cell.energy, cell.seeded
+                ).filter(cell.envid == envid).order_by(cell.coordinate).all()
+                room = Room(environment, cells, self._season_model.productions(),
+                            self._season_model.NEXT, self._profiler)
+                self._rooms[envid] = room
+                self._start()
+            return room
+
+    def join(self, username, agent):
+        """Host a freshly created agent row in its room, returns the room and the agent state."""
+        room = self.room(agent.envid)
+        state = room.add(agent)
+        self._players[username] = (room.id, agent.id)
+        return room, state
+
+    def _entry(self, username):
+        # players this process did not see yet, after a restart for instance, are looked up once.
+        entry = self._players.get(username)
+        if entry is None:
+            user = self._user_model.query.filter_by(username=username).first()
+            if user is None or user.agent is None:
+                return None
+            entry = (user.agent.envid, user.agent.id)
+            self._players[username] = entry
+        return entry
+
+    def player(self, username):
+        """Returns the room and the agent state of username, (None, None) if it has no agent."""
+        entry = self._entry(username)
+        if entry is None:
+            return None, None
+        room = self.room(entry[0])
+        agent = room.agents.get(entry[1])
+        if agent is None:
+            return None, None
+        return room, agent
+
+    def leave(self, username):
+        """Forget the agent of username, its row is deleted by the caller.
+
+        Returns its room and the log to emit there, (None, None) if it has no agent.
+        """
+        entry = self._entry(username)
+        if entry is None:
+            return None, None
+        del self._players[username]
+        room = self.room(entry[0])
+        agent, log = room.remove(entry[1])
+        if agent is None:
+            return None, None
+        if self._matchmaker is not None:
+            self._matchmaker.leave(entry[0], agent.type)
+        return room, log
+
+    def assign(self, create):
+        """Returns the environment id and the agent type of a new player.
+
+        The player goes to the least crowded environment with room left, create is called to make
+        a new one and returns its id when they are all full.
+        """
+        if self._matchmaker is None:
+            with self._lock:
+                if self._matchmaker is None:
+                    self._matchmaker = self._load_matchmaker()
+        return self._matchmaker.assign(create)
+
+    def _load_matchmaker(self):
+        # every environment and its agents by type in two queries, once per process.
+        matchmaker = Matchmaker(self._capacity)
+        session = self._db.session
+        counts = {envid: {} for envid, in session.query(self._environment_model.id)}
+        agent = self._agent_model
+        rows = session.query(agent.envid, agent.type, self._db.func.count(agent.id)).group_by(
+            agent.envid, agent.type)
+        for envid, kind, count in rows:
+            counts.setdefault(envid, {})[kind] = count
+        for envid, types in counts.items():
+            matchmaker.open(envid, types)
+        return matchmaker
+
+    def request_flush(self):
+        """Ask the writer to flush as soon as possible instead of waiting for the interval."""
+        self._wake.set()
+
+    def flush(self):
+        """Write every change of every room to the database in one transaction.
+
+        When it fails the transaction is rolled back and the changes are kept for the next flush.
+        """
+        with self._lock:
+            rooms = list(self._rooms.values())
+        session = self._db.session
+        collected = [(room, room.collect()) for room in rooms]
+        written = False
+        try:
+            for room, rows in collected:
+                for model, mappings in zip((self._environment_model, self._cell_model,
+                                            self._agent_model), rows):
+                    if mappings:
+                        session.bulk_update_mappings(model, mappings)
+                        written = True
+            if written:
+                session.commit()
+        except Exception:
+            session.rollback()
+            for room, rows in collected:
+                room.restore(*rows)
+            raise
+
+    def close(self):
+        """Stop the writer after a last flush."""
+        self._closed = True
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join()
+
+    def _start(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name='state-writer', daemon=True)
+            self._writer.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self._app.config['STATE_FLUSH_INTERVAL'])
+            self._wake.clear()
+            with self._app.app_context():
+                if self._profiler is not None:
+                    self._profiler.begin()
+                try:
+                    self.flush()
+                except Exception:
+                    # the writer keeps going, the next flush retries what this one could not write.
+                    logger.exception('Flushing the game state failed')
+                finally:
+                    if self._profiler is not None:
+                        self._profiler.end('writer.flush')
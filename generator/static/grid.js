@@ -1,86 +1,162 @@
 $(function() {
+    // What every agent can see of the room, kept in typed arrays indexed by i * width + j: the
+    // stored food and the number of ants and grasshoppers on every cell. The canvas is patched
+    // cell by cell when they change.
+    var grid = {
+        agents: {},
+        self: parseInt($('#username').data().agentid)
+    };
+
+    var sprites = {ant: new Image(), grasshopper: new Image()};
+    sprites.ant.onload = sprites.grasshopper.onload = function() { drawAll(); };
+    sprites.ant.src = $('#sprites').data().ant;
+    sprites.grasshopper.src = $('#sprites').data().grasshopper;
+
     function createGrid(height, width) {
-        var ratioW = Math.floor($('.grid').width() / width),
-            ratioH = Math.floor($('.grid').height() / height);
+        grid.height = height;
+        grid.width = width;
+        grid.stored = new Int32Array(height * width);
+        grid.ants = new Uint16Array(height * width);
+        grid.grasshoppers = new Uint16Array(height * width);
+        grid.agents = {};
+    }
+
+    // Put a canvas in the page that draws the grid, sized like the old one div per cell grid.
+    function mount() {
+        var parent = $('div.grid');
+        grid.size = Math.max(1, Math.floor(Math.min(parent.width() / grid.width,
+                                                    parent.height() / grid.height)));
+        var canvas = $('<canvas />').attr('width', grid.size * grid.width)
+                                    .attr('height', grid.size * grid.height);
+        parent.css('width', grid.size * grid.width + 1).css('height', grid.size * grid.height + 1)
+              .empty().append(canvas);
+        grid.context = canvas[0].getContext('2d');
+        drawAll();
+    }
 
-        var parent = $('div.grid').css('width', ratioW  * width + 1).css('height', ratioH  * height + 1);
+    function drawCell(k) {
+        var context = grid.context, size = grid.size;
+        var x = (k % grid.width) * size, y = Math.floor(k / grid.width) * size;
+        context.fillStyle = 'white';
+        context.fillRect(x, y, size, size);
+        if (grid.stored[k] > 0) {
+            context.fillStyle = 'rgba(101, 130, 153, ' + Math.min(grid.stored[k], 10) / 10 + ')';
+            context.fillRect(x, y, size, size);
+        }
+        if (size >= 4) {
+            context.strokeStyle = 'rgb(182, 182, 182)';
+            context.strokeRect(x + 0.5, y + 0.5, size - 1, size - 1);
+        }
 
-        for (var i = 0; i < width * height; i++) {
-            $('<div />', {
-                width: ratioW,
-                height: ratioH
-            }).appendTo(parent);
+        // an ant and a grasshopper on the same cell share it.
+        var ants = grid.ants[k] > 0, grasshoppers = grid.grasshoppers[k] > 0;
+        var half = ants && grasshoppers ? size / 2 : size;
+        if (ants && sprites.ant.complete) {
+            context.drawImage(sprites.ant, x, y, half, size);
+        }
+        if (grasshoppers && sprites.grasshopper.complete) {
+            context.drawImage(sprites.grasshopper, x + size - half, y, half, size);
+        }
 
-            if (Math.floor(i / width) ==  $('#agent').data().i
-                && i % width == $('#agent').data().j) {
-                    $('<img />', {
-                        src: $('#agent').data().link
-                    }).addClass('middle').appendTo(parent.children().last());
-                }
+        var self = grid.agents[grid.self];
+        if (self !== undefined && self.i * grid.width + self.j == k) {
+            context.strokeStyle = 'crimson';
+            context.strokeRect(x + 0.5, y + 0.5, Math.max(size - 1, 1), Math.max(size - 1, 1));
         }
     }
 
-    // Create the environment for the agent to reside on.
-    createGrid(parseInt($('#dimensions').data().height), parseInt($('#dimensions').data().width));
+    function drawAll() {
+        if (grid.context === undefined) return;
+        for (var k = 0; k < grid.height * grid.width; k++) {
+            drawCell(k);
+        }
+    }
 
-    function move(deltai, deltaj) {
-        var username = $('#username').data().username;
-        var xhr = new XMLHttpRequest();
-        xhr.open("POST", '/'+ username + '/move', true);
+    function occupancy(type) {
+        return type == 'ant' ? grid.ants : grid.grasshoppers;
+    }
 
-        xhr.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
-        xhr.onreadystatechange = function() {
-            if(xhr.readyState == XMLHttpRequest.DONE && xhr.status == 200) {
-                console.log(xhr.responseText);
-            }
+    // Put the agent on the cell (i, j), returns the cells to redraw.
+    function placeAgent(id, type, i, j) {
+        var changed = [], agent = grid.agents[id];
+        if (agent !== undefined) {
+            var before = agent.i * grid.width + agent.j;
+            occupancy(agent.type)[before] -= 1;
+            changed.push(before);
         }
-
-        xhr.send('deltai=' + deltai + '&deltaj=' + deltaj);
+        grid.agents[id] = {type: type, i: i, j: j};
+        occupancy(type)[i * grid.width + j] += 1;
+        changed.push(i * grid.width + j);
+        return changed;
     }
 
-    function forage() {
-        var username = $('#username').data().username;
-        var xhr = new XMLHttpRequest();
-        xhr.open("POST", '/'+ username + '/forage', true);
+    function removeAgent(id) {
+        var agent = grid.agents[id];
+        if (agent === undefined) return [];
+        delete grid.agents[id];
+        occupancy(agent.type)[agent.i * grid.width + agent.j] -= 1;
+        return [agent.i * grid.width + agent.j];
+    }
 
-        xhr.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
-        xhr.onreadystatechange = function() {
-            if(xhr.readyState == XMLHttpRequest.DONE && xhr.status == 200) {
-                console.log(xhr.responseText);
-            }
+    // Replace the whole state with the one the server sent when we joined.
+    function load(snapshot) {
+        createGrid(snapshot.height, snapshot.width);
+        grid.stored.set(snapshot.stored);
+        for (var k = 0; k < snapshot.agents.length; k++) {
+            var agent = snapshot.agents[k];
+            placeAgent(agent[0], agent[1], agent[2], agent[3]);
         }
+        mount();
+    }
 
-        xhr.send();
+    // Apply the changes of a round and only redraw the cells they touched.
+    function patch(delta) {
+        var changed = [], k;
+        for (k = 0; k < delta.cells.length; k++) {
+            grid.stored[delta.cells[k][0]] = delta.cells[k][1];
+            changed.push(delta.cells[k][0]);
+        }
+        for (k = 0; k < delta.agents.length; k++) {
+            var agent = delta.agents[k];
+            changed = changed.concat(placeAgent(agent[0], agent[1], agent[2], agent[3]));
+        }
+        for (k = 0; k < delta.left.length; k++) {
+            changed = changed.concat(removeAgent(delta.left[k]));
+        }
+        for (k = 0; k < changed.length; k++) {
+            drawCell(changed[k]);
+        }
     }
 
-    function eat() {
-        var username = $('#username').data().username;
-        var xhr = new XMLHttpRequest();
-        xhr.open("POST", '/'+ username + '/eat', true);
+    // Show the grid with our own agent until the whole room arrives.
+    createGrid(parseInt($('#dimensions').data().height), parseInt($('#dimensions').data().width));
+    placeAgent(grid.self, $('#agent').data().type, $('#agent').data().i, $('#agent').data().j);
+    mount();
 
-        xhr.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
-        xhr.onreadystatechange = function() {
-            if(xhr.readyState == XMLHttpRequest.DONE && xhr.status == 200) {
-                console.log(xhr.responseText);
-            }
-        }
+    // the page was served by the Socket.IO server itself.
+    var socket = io();
 
-        xhr.send();
+    // Play an action over the socket, the server answers whether it went through.
+    function act(message) {
+        socket.emit('action', message, function(played) {
+            console.log(message.action + (played ? ' played.' : ' refused.'));
+        });
     }
 
-    function be() {
-        var username = $('#username').data().username;
-        var xhr = new XMLHttpRequest();
-        xhr.open("POST", '/'+ username + '/be', true);
+    function move(deltai, deltaj) {
+        act({action: 'move', deltai: deltai, deltaj: deltaj});
+    }
 
-        xhr.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
-        xhr.onreadystatechange = function() {
-            if(xhr.readyState == XMLHttpRequest.DONE && xhr.status == 200) {
-                console.log(xhr.responseText);
-            }
-        }
+    function forage() {
+        act({action: 'forage'});
+    }
 
-        xhr.send();
+    function eat() {
+        act({action: 'eat'});
+    }
+
+    function be() {
+        act({action: 'be'});
     }
 
     $(window).keydown(function(e) {
@@ -119,42 +195,54 @@ $(function() {
         }
     })
 
-    var socket = io.connect('http://localhost:5000');
+    function isDead(message) {
+        var agent_id = $('#username').data().agentid;
+        for (var i = 0; i < message.dead.length; i++) {
+            if (message.dead[i] == agent_id) return true;
+        }
+        return false;
+    }
+
+    socket.on('connect', function() {
+        // register this page so that the server sends our percepts to us alone.
+        socket.emit('join', {username: $('#username').data().username});
+    });
+
+    // A player is still missing: the end of the round comes as a delta.
     socket.on('refresh', function(message) {
-        var id = $('#dimensions').data().id;
-        console.log(message);
-        if (message.id == id) {
-            if (message.remaining == 0) {
-                agent_id = $('#username').data().agentid;
-                var is_dead = false;
-                for (var i = 0; i < message.dead.length; i++) {
-                    if (message.dead[i] == agent_id) is_dead = true;
-                }
-                if (is_dead) {
-                    console.log('dead');
-                    // redirect to game over screen.
-                    window.location.replace("/" + $('#username').data().username + '/erase');
-                    return ;
-                }
-                // trigger a refresh.
-                var xhr = new XMLHttpRequest();
-                xhr.onreadystatechange = function() { 
-                    if (xhr.readyState == 4 && xhr.status == 200) {
-                        $('#environment').empty();
-                        $('#environment').html(xhr.responseText);
-                        createGrid(parseInt($('#dimensions').data().height), parseInt($('#dimensions').data().width));
-                    }
-                }
-                var username = $('#username').data().username;
-                xhr.open("GET", '/' + username + '/refresh', true); // true for asynchronous 
-                xhr.send(null);
-
-                console.log('refresh has been signaled.');
-                $('#informative').hide();
-            } else {
-                $('#informative > span').text('Waiting for ' + message.remaining + ' players.');
-                $('#informative').show();
-            }
-        } else console.log('refresh was broadcasted.');
+        if (message.id != $('#dimensions').data().id) return;
+        $('#informative > span').text('Waiting for ' + message.remaining + ' players.');
+        $('#informative').show();
+    });
+
+    // End of a round: patch the page in place with what changed instead of reloading it.
+    socket.on('delta', function(message) {
+        if (message.id != $('#dimensions').data().id) return;
+        if (isDead(message)) {
+            window.location.replace("/" + $('#username').data().username + '/erase');
+            return ;
+        }
+        patch(message);
+        $('#day').text(message.t);
+        $('#season').text(message.season);
+        $('#informative').hide();
+    });
+
+    socket.on('snapshot', function(message) {
+        if (message.id != $('#dimensions').data().id) return;
+        load(message);
+    });
+
+    socket.on('percepts', function(message) {
+        if (message.id != $('#username').data().agentid) return;
+        var changed = placeAgent(message.id, grid.agents[message.id].type, message.i, message.j);
+        for (var k = 0; k < changed.length; k++) {
+            drawCell(changed[k]);
+        }
+        $('#position').text(message.i + ', ' + message.j);
+        $('p.energy').text('energy ' + message.energy);
+        for (var key in message.percepts) {
+            $('p.' + key).text(key + ' ' + message.percepts[key]);
+        }
     });
-})
\ No newline at end of file
+})
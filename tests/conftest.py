@@ -0,0 +1,32 @@
+"""Shared setup of the tests.
+
+The env.py modules import each other as top-level modules, and the app reads its settings from
+GENERATOR_SETTINGS when it is imported, so both are set up before any test module is collected.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'env'))
+
+_directory = tempfile.mkdtemp(prefix='generator-tests-')
+_settings = os.path.join(_directory, 'settings.py')
+with open(_settings, 'w') as settings:
+    settings.write("SQLALCHEMY_DATABASE_URI = 'sqlite:///%s'\n" % os.path.join(_directory, 'test.db'))
+    # the tests flush by hand.
+    settings.write('STATE_FLUSH_INTERVAL = 3600\n')
+os.environ['GENERATOR_SETTINGS'] = _settings
+
+@pytest.fixture
+def models():
+    """The generator module with an empty database, inside an app context."""
+    from generator import generator
+
+    with generator.app.app_context():
+        generator.db.drop_all()
+        generator.db.create_all()
+        generator.Season.invalidate()
+        yield generator
+        generator.db.session.remove()
@@ -0,0 +1,112 @@
+"""Copy-on-write forks of an Environment and the ForkedGrid they run on."""
+import numpy as np
+
+import env
+
+def _views(grid):
+    return grid.newly.copy(), grid.stored.copy(), grid.seeded.copy()
+
+def _same(grid, views):
+    return all((field == view).all() for field, view in zip(_views(grid), views))
+
+def _check_sampling(grid, rng):
+    # brute force: samples are always under capacity and there is one whenever a cell has room.
+    free = grid.newly < grid.capacity
+    for _ in range(20):
+        spot = grid.sample_free(rng)
+        if not free.any():
+            assert spot is None
+            return
+        assert free[spot]
+
+def test_forked_grid_matches_a_plain_grid():
+    rng = np.random.default_rng(0)
+    plain = env.Grid(9, 11, incremental=True, rng=rng)
+    plain.newly[:] = rng.integers(0, 6, size=plain.newly.shape)
+    plain.set_capacity(6)
+    plain.track()
+    base = env.Grid.from_arrays(plain.newly.copy(), plain.stored.copy(), plain.energy,
+                                plain.seeded.copy(), plain.free.copy(), plain.slot.copy(),
+                                plain.nfree, plain.capacity, incremental=True)
+    frozen = _views(base)
+    forked = env.ForkedGrid(base)
+
+    for step in range(3000):
+        i, j = int(rng.integers(9)), int(rng.integers(11))
+        op = int(rng.integers(7))
+        capacity = int(rng.integers(3, 9))
+        for grid in (plain, forked):
+            if op == 0:
+                grid.produce(i, j, 1)
+            elif op == 1:
+                grid.store(i, j, 1)
+            elif op == 2 and grid.stored_at(i, j) > 0:
+                grid.consume(i, j)
+            elif op == 3 and grid.newly_at(i, j) > 0:
+                grid.decrease_newly(i, j, 1)
+            elif op == 4:
+                grid.set_seeded(i, j, bool(step % 2))
+            elif op == 5 and step % 50 == 0:
+                grid.set_capacity(capacity)
+        if op == 6:
+            assert forked.emptied() == plain.emptied()
+        if step % 200 == 0:
+            # carry on with a fork, writes to another fork do not reach it.
+            forked = forked.fork()
+            views = _views(forked)
+            probe = forked.fork()
+            probe.produce(i, j, 1)
+            probe.set_seeded(i, j, not probe.seeded_at(i, j))
+            assert _same(forked, views)
+        assert _same(forked, _views(plain))
+        assert forked.capacity == plain.capacity
+        _check_sampling(forked, rng)
+    assert _same(base, frozen)
+
+def _world(size=20):
+    world = env.Environment(size, size, 5, [10, 20, 10, 5], seed=2)
+    agents = [env.Ant(20, 10**6, world, 1, 2, 1, 1) for _ in range(8)]
+    agents.append(env.GrassHoper(20, 10**6, world, 1, 2, 1, 1))
+    return world, agents
+
+def _play(agents, rounds):
+    for k in range(rounds):
+        for agent in agents:
+            if isinstance(agent, env.Ant):
+                agent.forage()
+            agent.eat()
+            agent.move(1 if k % 2 else -1, 1 if k % 3 else -1)
+
+def test_forks_are_isolated():
+    world, agents = _world()
+    first, first_agents = world.fork(agents)
+    second, second_agents = world.fork(agents)
+    views = _views(world.grid)
+    records = [agent.record() for agent in agents]
+
+    _play(first_agents, 30)
+    assert _same(world.grid, views)
+    assert _same(second.grid, views)
+    assert [agent.record() for agent in agents] == records
+    assert [agent.record() for agent in second_agents] == records
+    assert not _same(first.grid, views)
+
+def test_parent_overlay_stays_bounded():
+    world, agents = _world()
+    world.fork(agents)
+    limit = world.height * world.width // 4
+    rng = np.random.default_rng(3)
+    for _ in range(40):
+        _play(agents, 5)
+        assert len(world.grid._cells) <= limit
+        _check_sampling(world.grid, rng)
+
+def test_fork_taken_in_a_round_ticks_on_its_own():
+    world, agents = _world()
+    with world.round():
+        agents[0].move(1, 0)
+        fork, fork_agents = world.fork(agents)
+        fork_agents[1].move(0, 1)
+        assert fork._t == 1
+        assert world._t == 0
+    assert world._t == 1
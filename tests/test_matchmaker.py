@@ -0,0 +1,86 @@
+"""Matchmaker against a scan of every environment."""
+from collections import Counter
+import itertools
+import random
+import threading
+
+import pytest
+
+from generator.state import Matchmaker
+
+class Scan(object):
+    """What the matchmaker must do, by looking at every environment each time."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def assign(self, create):
+        open_ = [(sum(counts.values()), envid) for envid, counts in self.counts.items()
+                 if sum(counts.values()) < self.capacity]
+        if open_:
+            envid = min(open_)[1]
+        else:
+            envid = create()
+            self.counts[envid] = Counter()
+        counts = self.counts[envid]
+        kind = 'grasshopper' if counts['grasshopper'] < counts['ant'] else 'ant'
+        counts[kind] += 1
+        return envid, kind
+
+    def leave(self, envid, kind):
+        if self.counts[envid][kind] > 0:
+            self.counts[envid][kind] -= 1
+
+@pytest.mark.parametrize('seed', range(20))
+def test_assign_against_a_scan(seed):
+    rng = random.Random(seed)
+    capacity = rng.randint(1, 5)
+    matchmaker, scan = Matchmaker(capacity), Scan(capacity)
+    ids = itertools.count(1)
+    players = []
+    for envid in range(rng.randint(0, 3)):
+        counts = {'ant': rng.randint(0, capacity)}
+        counts['grasshopper'] = rng.randint(0, capacity - counts['ant'])
+        matchmaker.open(-envid, counts)
+        scan.counts[-envid] = Counter(counts)
+        players.extend((-envid, kind) for kind, count in counts.items() for _ in range(count))
+
+    for _ in range(300):
+        if players and rng.random() < 0.4:
+            envid, kind = players.pop(rng.randrange(len(players)))
+            matchmaker.leave(envid, kind)
+            scan.leave(envid, kind)
+        else:
+            envid = next(ids)
+            created = matchmaker.assign(lambda: envid)
+            assert created == scan.assign(lambda: envid)
+            players.append(created)
+        assert {envid: +counts for envid, counts in matchmaker._counts.items()} == \
+            {envid: +counts for envid, counts in scan.counts.items()}
+
+def test_leaving_twice_is_ignored():
+    matchmaker = Matchmaker(2)
+    matchmaker.open(1, {'ant': 1, 'grasshopper': 1})
+    matchmaker.leave(1, 'grasshopper')
+    matchmaker.leave(1, 'grasshopper')
+    matchmaker.leave(7, 'ant')
+    assert matchmaker.assign(lambda: 2) == (1, 'grasshopper')
+    assert matchmaker.assign(lambda: 2) == (2, 'ant')
+
+def test_concurrent_players_never_overfill():
+    capacity = 4
+    matchmaker = Matchmaker(capacity)
+    ids = itertools.count(1)
+    assigned = []
+
+    def player():
+        for _ in range(50):
+            assigned.append(matchmaker.assign(lambda: next(ids)))
+
+    threads = [threading.Thread(target=player) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    per_environment = Counter(envid for envid, kind in assigned)
+    assert sorted(per_environment.values()) == [capacity] * (400 // capacity)
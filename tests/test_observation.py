@@ -0,0 +1,46 @@
+"""Observer windows against cells read one by one."""
+import numpy as np
+import pytest
+
+from observation import CHANNELS, MASKED, NEWLY, OCCUPANCY, STORED, Observer
+
+def _window(newly, stored, i, j, world, ant, k, a):
+    """The window of agent a read cell by cell."""
+    worlds, height, width = newly.shape
+    radius = k // 2
+    window = np.full((CHANNELS, k, k), MASKED, dtype=np.int32)
+    for r in range(k):
+        for c in range(k):
+            row, col = i[a] + r - radius, j[a] + c - radius
+            if 0 <= row < height and 0 <= col < width:
+                if ant[a]:
+                    window[NEWLY, r, c] = newly[world[a], row, col]
+                window[STORED, r, c] = stored[world[a], row, col]
+                window[OCCUPANCY, r, c] = np.sum((world == world[a]) & (i == row) & (j == col))
+    return window
+
+@pytest.mark.parametrize('seed', range(30))
+def test_windows_against_a_scan(seed):
+    rng = np.random.default_rng(seed)
+    height, width = rng.integers(1, 10, 2)
+    k = int(rng.choice([1, 3, 5, 7]))
+    worlds = int(rng.integers(1, 4))
+    n = int(rng.integers(1, 25))
+    newly = rng.integers(0, 20, (worlds, height, width)).astype(np.int32)
+    stored = rng.integers(0, 20, (worlds, height, width)).astype(np.int32)
+    i, j = rng.integers(0, height, n), rng.integers(0, width, n)
+    world, ant = rng.integers(0, worlds, n), rng.random(n) < 0.5
+
+    observer = Observer(height, width, k, worlds)
+    for _ in range(2):
+        # the second call checks nothing of the first one is left over.
+        out = observer.observe(newly, stored, i, j, ant, world)
+        for a in range(n):
+            assert np.array_equal(out[a], _window(newly, stored, i, j, world, ant, k, a))
+    if worlds == 1:
+        single = Observer(height, width, k).observe(newly[0], stored[0], i, j, ant)
+        assert np.array_equal(single, out)
+
+def test_no_agents():
+    assert Observer(4, 4, 3).observe(np.zeros((4, 4)), np.zeros((4, 4)), [], [], []).shape == \
+        (0, CHANNELS, 3, 3)
@@ -0,0 +1,96 @@
+"""Snapshots written by Environment.save and mapped back by Environment.load."""
+import numpy as np
+import pytest
+
+import env
+
+def _play(world, agents, rounds):
+    for k in range(rounds):
+        for agent in agents:
+            if isinstance(agent, env.Ant):
+                agent.forage()
+            agent.eat()
+            agent.move(1 if k % 2 else -1, 0)
+
+def _world(incremental=False, seed=1):
+    world = env.Environment(6, 7, 5, [10, 20, 10, 5], incremental, seed=seed)
+    agents = [env.Ant(20, 30, world, 1, 2, 1, 1), env.Ant(20, 30, world, 1, 2, 1, 1),
+              env.GrassHoper(20, 30, world, 1, 2, 1, 3)]
+    _play(world, agents, 8)
+    return world, agents
+
+def _check_free_index(grid):
+    # brute force: the indexed cells are exactly the ones under capacity, slot points back at them.
+    free = grid.free[:grid.nfree]
+    expected = np.flatnonzero(grid.newly.reshape(-1) < grid.capacity)
+    assert sorted(free.tolist()) == expected.tolist()
+    assert (grid.slot[free] == np.arange(grid.nfree)).all()
+    assert (np.delete(grid.slot, free) == -1).all()
+
+def test_roundtrip(tmp_path):
+    world, agents = _world()
+    path = tmp_path / 'world.snap'
+    world.save(path, agents)
+    loaded, loaded_agents = env.Environment.load(path)
+
+    for field in ('newly', 'stored', 'energy', 'seeded'):
+        assert (getattr(loaded.grid, field) == getattr(world.grid, field)).all(), field
+    assert loaded.grid.capacity == world.grid.capacity
+    _check_free_index(loaded.grid)
+    assert (loaded.height, loaded.width) == (world.height, world.width)
+    assert (loaded._t, loaded._season, loaded._cycle) == (world._t, world._season, world._cycle)
+    assert loaded._food_per_season == world._food_per_season
+    assert [agent.record() for agent in loaded_agents] == [agent.record() for agent in agents]
+    assert [type(agent) for agent in loaded_agents] == [type(agent) for agent in agents]
+    for agent in loaded_agents:
+        assert agent in loaded.agents_at(agent.i, agent.j)
+
+def test_loaded_environments_do_not_write_back(tmp_path):
+    world, agents = _world()
+    path = tmp_path / 'world.snap'
+    world.save(path, agents)
+    before = path.read_bytes()
+
+    # two loads with the same seed play the same game, neither touches the file or the other.
+    first, first_agents = env.Environment.load(path, seed=7)
+    second, second_agents = env.Environment.load(path, seed=7)
+    _play(first, first_agents, 10)
+    assert (second.grid.newly == world.grid.newly).all()
+    _play(second, second_agents, 10)
+    assert (first.grid.newly == second.grid.newly).all()
+    assert (first.grid.stored == second.grid.stored).all()
+    assert [agent.record() for agent in first_agents] == [agent.record() for agent in second_agents]
+    _check_free_index(first.grid)
+    assert path.read_bytes() == before
+
+def test_incremental_grid_tracks_emptied_cells(tmp_path):
+    world, agents = _world(incremental=True)
+    world.grid.newly[0, :] = 0
+    world.grid.seeded[0, :] = False
+    path = tmp_path / 'world.snap'
+    world.save(path, agents)
+    loaded, _ = env.Environment.load(path)
+
+    grid = loaded.grid
+    expected = {tuple(cell) for cell in np.argwhere((grid.newly == 0) & ~grid.seeded).tolist()}
+    assert grid.dirty == expected
+    assert set(grid.emptied()) == expected
+
+def test_forked_environment_saves_its_own_view(tmp_path):
+    world, agents = _world()
+    fork, fork_agents = world.fork(agents)
+    _play(fork, fork_agents, 5)
+    path = tmp_path / 'fork.snap'
+    fork.save(path, fork_agents)
+    loaded, loaded_agents = env.Environment.load(path)
+
+    for field in ('newly', 'stored', 'seeded'):
+        assert (getattr(loaded.grid, field) == getattr(fork.grid, field)).all(), field
+    _check_free_index(loaded.grid)
+    assert [agent.record() for agent in loaded_agents] == [agent.record() for agent in fork_agents]
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.snap'
+    path.write_bytes(b'\0' * 256)
+    with pytest.raises(ValueError):
+        env.Environment.load(path)
@@ -0,0 +1,235 @@
+"""In-memory rooms and the store writing them back to the database."""
+from collections import defaultdict
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from generator.state import GameStore, Room
+
+PRODUCTIONS = {'spring': 10, 'summer': 17, 'fall': 12, 'winter': 7}
+NEXT = {'spring': 'summer', 'summer': 'fall', 'fall': 'winter', 'winter': 'spring'}
+
+def _agent(agent_id, kind='ant', i=0, j=0, energy=50):
+    return SimpleNamespace(id=agent_id, type=kind, user_id=None, max_energy=100, energy=energy,
+                           be_cost=1, eat_cost=1, move_cost=2,
+                           forage_cost=2 if kind == 'ant' else None,
+                           sing_cost=2 if kind == 'grasshopper' else None,
+                           i=i, j=j, has_played=False)
+
+def _room(agents, height=3, width=4, newly=None, stored=None, seeded=None):
+    size = height * width
+    environment = SimpleNamespace(id=1, height=height, width=width, cycle=4, t=0,
+                                  season_desc='spring', nrequest_daily=0, agents=agents)
+    cells = [SimpleNamespace(id=100 + k, newly=newly[k] if newly else 5,
+                             stored=stored[k] if stored else 0, energy=3,
+                             seeded=seeded[k] if seeded else False)
+             for k in range(size)]
+    return Room(environment, cells, PRODUCTIONS, NEXT)
+
+def test_actions_follow_the_rules():
+    room = _room([_agent(1, 'ant'), _agent(2, 'grasshopper', 2, 3), _agent(3, 'ant', 1, 1)])
+    ant, hopper = room.agents[1], room.agents[2]
+
+    assert room.move(ant, -1, 0) is None
+    assert room.move(ant, 2, 0) is None
+    assert room.forage(hopper) is None
+    assert room.eat(hopper) is None
+
+    assert room.forage(ant) is not None
+    assert (room.newly[0], room.stored[0], ant.energy) == (4, 1, 48)
+    assert room.move(ant, 1, 1) is None
+
+    assert room.move(hopper, 1, 0) is None
+    assert room.move(hopper, -1, -1) is not None
+    assert (hopper.i, hopper.j, hopper.energy) == (1, 2, 48)
+    assert room.percepts(hopper) == {'stored': 0}
+    assert room.percepts(ant) == {'newly': 4, 'stored': 1}
+
+def test_round_ends_once_everyone_played():
+    room = _room([_agent(1), _agent(2, 'grasshopper', 1, 1)])
+    first = room.be(room.agents[1])
+    assert first == {'id': 1, 'remaining': 1}
+    assert room.be(room.agents[1]) is None
+
+    last = room.be(room.agents[2])
+    assert last['remaining'] == 0 and last['dead'] == []
+    delta = last['delta']
+    assert (delta['t'], delta['season'], delta['left']) == (1, 'spring', [])
+    assert sorted(agent[0] for agent in delta['agents']) == [1, 2]
+    assert room.nrequest_daily == 0
+    assert not any(agent.has_played for agent in room.agents.values())
+    # the next round starts from scratch.
+    assert room.be(room.agents[2]) == {'id': 1, 'remaining': 1}
+
+def test_seasons_follow_the_cycle():
+    room = _room([_agent(1)])
+    seasons = []
+    for _ in range(9):
+        room.be(room.agents[1])
+        seasons.append((room.t, room.season_desc))
+    assert seasons[3] == (0, 'summer') and seasons[7] == (0, 'fall')
+
+@pytest.mark.parametrize('seed', range(20))
+def test_simulate_against_a_scan(seed):
+    rng = random.Random(seed)
+    random.seed(seed)
+    size = 30
+    newly = [rng.choice([0, 0, 3, 9, 10]) for _ in range(size)]
+    seeded = [rng.random() < 0.3 for _ in range(size)]
+    room = _room([_agent(1)], height=5, width=6, newly=newly, seeded=seeded)
+
+    room.simulate()
+    production = PRODUCTIONS['spring']
+    # brute force over every cell: what ran out seeded, full cells were left alone and every cell
+    # that changed is written back.
+    changed = {k for k in range(size)
+               if (room.newly[k], bool(room.seeded[k])) != (newly[k], seeded[k])}
+    assert changed <= room.dirty_cells
+    for k in range(size):
+        if newly[k] >= production:
+            assert room.newly[k] == newly[k]
+        assert room.newly[k] <= max(production, newly[k])
+        if newly[k] == 0 and not seeded[k]:
+            assert room.seeded[k] or room.newly[k] > 0
+    seeded_into = [k for k in range(size) if room.newly[k] > newly[k]]
+    emptied = sum(1 for k in range(size) if newly[k] == 0 and not seeded[k])
+    assert len(seeded_into) <= emptied
+    if any(newly[k] < production for k in range(size)):
+        assert seeded_into or not emptied
+
+def test_occupants_against_a_scan():
+    rng = random.Random(4)
+    room = _room([_agent(k, rng.choice(['ant', 'grasshopper']), rng.randrange(3), rng.randrange(4),
+                         energy=1000) for k in range(1, 9)])
+    for _ in range(60):
+        for agent in list(room.agents.values()):
+            room.move(agent, rng.randint(-1, 1), rng.randint(-1, 1)) or room.be(agent)
+        scan = defaultdict(set)
+        for agent in room.agents.values():
+            scan[agent.i * room.width + agent.j].add(agent.id)
+        assert room.occupants == scan
+        i, j = rng.randrange(3), rng.randrange(4)
+        assert {agent.id for agent in room.at(i, j)} == scan.get(i * room.width + j, set())
+
+def test_collect_and_restore():
+    room = _room([_agent(1), _agent(2, 'ant', 2, 2)])
+    room.forage(room.agents[1])
+    environment, cells, agents = room.collect()
+    assert environment == [{'id': 1, 't': 0, 'season_desc': 'spring', 'nrequest_daily': 1}]
+    assert cells == [{'id': 100, 'newly': 4, 'stored': 1, 'seeded': False}]
+    assert agents == [{'id': 1, 'energy': 48, 'i': 0, 'j': 0, 'has_played': True}]
+    assert room.collect() == ([], [], [])
+
+    room.restore(environment, cells, agents)
+    room.forage(room.agents[2])
+    environment, cells, agents = room.collect()
+    assert len(environment) == 1
+    assert sorted(cell['id'] for cell in cells) == [100, 110]
+    assert sorted(agent['id'] for agent in agents) == [1, 2]
+
+def test_leaving_ends_the_round():
+    room = _room([_agent(1), _agent(2, 'ant', 1, 1), _agent(3, 'ant', 2, 2)])
+    room.be(room.agents[1])
+    room.be(room.agents[2])
+
+    # the action of an agent that leaves no longer counts.
+    agent, log = room.remove(2)
+    assert agent.id == 2 and log == {'id': 1, 'remaining': 1}
+    assert 'delta' not in log and room.t == 0
+
+    agent, log = room.remove(3)
+    assert log['delta']['left'] == [2, 3] and room.t == 1
+    assert room.remove(3) == (None, None)
+    assert room.occupants == {0: {1}}
+
+def _player(models, username, envid, kind, i=0, j=0):
+    model = models.Ant if kind == 'ant' else models.Grasshopper
+    extra = {'forage_cost': 2} if kind == 'ant' else {'sing_cost': 2}
+    user = models.User(username=username)
+    agent = model(max_energy=100, energy=90, be_cost=1, eat_cost=1, move_cost=2, envid=envid,
+                  has_played=False, i=i, j=j, **extra)
+    user.agent = agent
+    models.db.session.add_all([user, agent])
+    models.db.session.commit()
+    return agent
+
+def _store(models, capacity=10):
+    return GameStore(models.app, models.db, models.Environment, models.Cell, models.Agent,
+                     models.User, models.Season, None, capacity)
+
+def test_flush_writes_rooms_back(models):
+    envid = models.create_environment()
+    rows = [_player(models, 'u0', envid, 'ant'), _player(models, 'u1', envid, 'grasshopper', 1, 1)]
+    store = _store(models)
+    try:
+        for username, row in zip(('u0', 'u1'), rows):
+            store.join(username, row)
+        for _ in range(3):
+            for username in ('u0', 'u1'):
+                room, agent = store.player(username)
+                room.forage(agent) or room.move(agent, 1, 0) or room.be(agent)
+        room.be(store.player('u0')[1])
+        store.flush()
+
+        models.db.session.expire_all()
+        environment = models.db.session.get(models.Environment, envid)
+        assert (environment.t, environment.nrequest_daily) == (room.t, room.nrequest_daily)
+        assert [cell.newly for cell in environment.cells] == list(room.newly)
+        assert [cell.stored for cell in environment.cells] == list(room.stored)
+        assert [bool(cell.seeded) for cell in environment.cells] == list(map(bool, room.seeded))
+        written = sorted((agent.id, agent.energy, agent.i, agent.j, agent.has_played)
+                         for agent in environment.agents)
+        assert written == sorted((agent.id, agent.energy, agent.i, agent.j, agent.has_played)
+                                 for agent in room.agents.values())
+    finally:
+        store.close()
+
+def test_failed_flush_is_retried(models, monkeypatch):
+    envid = models.create_environment()
+    store = _store(models)
+    try:
+        room, agent = store.join('u0', _player(models, 'u0', envid, 'ant'))
+        room.be(agent)
+        session = models.db.session
+        commit = session.commit
+
+        def failing():
+            raise RuntimeError('disk full')
+        monkeypatch.setattr(session, 'commit', failing)
+        with pytest.raises(RuntimeError):
+            store.flush()
+        monkeypatch.setattr(session, 'commit', commit)
+        store.flush()
+
+        session.expire_all()
+        written = session.get(models.Agent, agent.id)
+        assert (written.energy, written.has_played) == (agent.energy, agent.has_played)
+        assert session.get(models.Environment, envid).t == room.t == 1
+    finally:
+        store.close()
+
+def test_leaving_after_a_restart(models):
+    envid = models.create_environment()
+    rows = [_player(models, 'u%d' % k, envid, kind, k, 0)
+            for k, kind in enumerate(('ant', 'grasshopper', 'ant'))]
+
+    def create():
+        raise AssertionError('no environment should be created')
+
+    # a new process knows nobody until they act.
+    store = _store(models, capacity=4)
+    try:
+        assert store.assign(create) == (envid, 'grasshopper')
+        room, agent = store.player('u1')
+        room.be(agent)
+        room.be(store.player('u2')[1])
+
+        left, log = store.leave('u0')
+        assert left is room and rows[0].id not in room.agents
+        assert 'delta' in log and room.t == 1
+        assert store.leave('u0') == (None, None)
+        # the place of u0 is open again.
+        assert store.assign(create) == (envid, 'ant')
+    finally:
+        store.close()